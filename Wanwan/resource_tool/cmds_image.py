@@ -1,10 +1,13 @@
 import struct
+import numpy as np
 from PIL import Image
 from util import check_files, make_dirs_for_file
 from util import load_palette, palette_to_rgba, print_palette_rgba
 from util import col2rgb, rgb2col
-from util import load_image_as_indexed
-from lzss_ww import compress, decompress
+from util import load_image_as_indexed, nearest_color_indices
+from lzss_ww import decompress, LEVEL_NAMES
+from lzss_cache import compress_cached
+from palette_lut import quantize_to_palette, PERCEPTUAL_WEIGHTS
 
 def cmd_decode_image(args):
 	# Parse and verify command arguments
@@ -63,24 +66,21 @@ def cmd_decode_image(args):
 	
 	# Convert to output format
 	if indexed:
-		img = Image.new("P", (img_width, img_height), color = 0)
+		img = Image.frombytes("P", (img_width, img_height), bytes(data_image))
 		palette_rgb_flat = [0]*(palette_size*3)
 		for i in range(palette_size):
 			palette_rgb_flat[i*3:i*3+3] = list(palette_rgba[i])[:3]
 		img.putpalette(palette_rgb_flat)
-		img.putdata(data_image)
 		if transp:
 			img.info["transparency"] = 0
 	else:
-		img = Image.new("RGBA", (img_width, img_height), color = (0,0,0,0))
-		pix = img.load()
-		for x in range(img_width):
-			for y in range(img_height):
-				ci = data_image[y*img_width+x]
-				if ci >= palette_size:
-					print(f"Invalid color {ci} at {x},{y}")
-					continue
-				pix[x,y] = palette_rgba[ci]
+		# Look up every pixel at once, colors past the end of the palette stay transparent
+		pixels = np.frombuffer(bytes(data_image), dtype=np.uint8).reshape(img_height, img_width)
+		palette_lut = np.zeros((256, 4), dtype=np.uint8)
+		palette_lut[:palette_size] = palette_rgba[:256]
+		for y, x in sorted(zip(*np.nonzero(pixels >= palette_size)), key=lambda p: (p[1], p[0])):
+			print(f"Invalid color {pixels[y,x]} at {x},{y}")
+		img = Image.fromarray(palette_lut[pixels])
 	
 	# Write output image
 	print(f"Saving to {im_out}")
@@ -97,10 +97,17 @@ def cmd_encode_image(args):
 	comp = args.compressed
 	indexed = args.indexed
 	dither = args.dither
+	weighted = args.weighted
+	table = args.table
+	level = args.level
+	cache = args.cache
 	if not check_files(exist=[im_in] if indexed else [im_in, res_pal_in], noexist=[res_im_out]):
 		return False
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
 	print("Transparent: " + ("YES" if transp else "NO"))
-	print("Compressed: " + ("YES" if comp else "NO"))
+	print("Compressed: " + (f"YES ({LEVEL_NAMES[level]})" if comp else "NO"))
 	print("Indexed-color: " + ("YES" if indexed else "NO"))
 	print("Dither: " + ("YES" if dither else "NO"))
 	
@@ -123,12 +130,11 @@ def cmd_encode_image(args):
 		img = load_image_as_indexed(img, 256)
 		if img == None:
 			return False
-		data_image = list(img.getdata())
+		data_image = np.asarray(img)
 	else:
 		img = img.convert("RGBA")
 		if transp:
-			img_alpha = img.getchannel("A").convert("1")
-			img_alpha_px = img_alpha.load()
+			img_alpha = np.asarray(img.getchannel("A").convert("1"))
 		
 		with open(res_pal_in, "rb") as f:
 			data_palette = f.read()
@@ -145,41 +151,34 @@ def cmd_encode_image(args):
 		# Make opaque by compositing over first color, so we can use dithering later
 		img = Image.alpha_composite(Image.new("RGBA", img.size, palette_rgba[0]), img).convert("RGB")
 		
-		# Extend palette to 256 colors and create an image with it
-		last_color = palette_rgba[-1]
-		if palette_size < 256:
-			palette_rgba += [last_color]*(256-palette_size)
-		palette_rgb_flat = [0]*(palette_size*3)
-		for i in range(palette_size):
-			palette_rgb_flat[i*3:i*3+3] = list(palette_rgba[i])[:3]
-		img_palette = Image.new("P", (16,16))
-		img_palette.putpalette(palette_rgb_flat)
-		
-		# Quantize to palette with optional dithering
-		dither_method = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
-		img_quantized = img.quantize(dither=dither_method, palette=img_palette)
+		# Quantize to palette, dithering diffuses error from pixel to pixel so it is left to PIL
+		if dither:
+			palette_rgb_flat = [0]*(palette_size*3)
+			for i in range(palette_size):
+				palette_rgb_flat[i*3:i*3+3] = list(palette_rgba[i])[:3]
+			img_palette = Image.new("P", (16,16))
+			img_palette.putpalette(palette_rgb_flat)
+			img_quantized = img.quantize(dither=Image.Dither.FLOYDSTEINBERG, palette=img_palette)
+			data_image = np.minimum(np.asarray(img_quantized), palette_size-1)
+		elif table:
+			data_image = quantize_to_palette(np.asarray(img), data_palette, weighted, cache)
+		else:
+			data_image = nearest_color_indices(np.asarray(img), [c[:3] for c in palette_rgba], PERCEPTUAL_WEIGHTS if weighted else None)
 		
-		# Extract pixel values and reapply transparency
-		data_image = bytearray(img.width*img.height)
-		img_quantized_px = img_quantized.load()
-		for x in range(img.width):
-			for y in range(img.height):
-				cv = 0
-				if (not transp) or img_alpha_px[x,y]:
-					cv = min(img_quantized_px[x,y], palette_size-1)
-					if transp:
-						cv += 1
-				data_image[y*img.width+x] = cv
+		# Reapply transparency
+		if transp:
+			data_image = np.where(img_alpha, data_image+1, 0).astype(np.uint8)
 	
 	# Serialize image and palette data
-	data_image = struct.pack("BB", img.width&255, img.height&255) + bytes(data_image)
+	data_image = struct.pack("BB", img.width&255, img.height&255) + data_image.tobytes()
 	
 	# Compress image data if necessary
 	if comp:
-		data_image = compress(data_image)
+		data_image = compress_cached(data_image, level, cache)
 	
 	# Write output data
 	print(f"Saving to {res_im_out}")
 	make_dirs_for_file(res_im_out)
 	with open(res_im_out, "wb") as f:
 		f.write(data_image)
+	return True
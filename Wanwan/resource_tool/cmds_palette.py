@@ -1,7 +1,10 @@
 import struct
+import numpy as np
 from PIL import Image
 from util import check_files, make_dirs_for_file
-from util import col2rgb, load_palette, palette_to_rgba, print_palette_rgba, rgb2col
+from util import load_palette, palette_to_rgba, print_palette_rgba, rgb2col
+from palette_lut import PERCEPTUAL_WEIGHTS
+from palette_quant import color_histogram, derive_palette, METHOD_NAMES
 
 def cmd_decode_palette(args):
 	# Parse and verify command arguments
@@ -41,79 +44,59 @@ def cmd_decode_palette(args):
 
 def cmd_derive_palette(args):
 	# Parse and verify command arguments
-	im_in = args.path_image_in
+	ims_in = args.path_image_in
 	res_pal_out = args.path_res_pal_out
 	transp = args.transparent
 	palette_size = args.palsize
-	if not check_files(exist=[im_in], noexist=[res_pal_out]):
+	method = args.method
+	iterations = args.iterations
+	weighted = args.weighted
+	if not check_files(exist=ims_in, noexist=[res_pal_out]):
 		return False
 	if palette_size < (2 if transp else 1) or palette_size > 256:
 		print("Palette size out of range")
 		return False
+	if method < 0 or method >= len(METHOD_NAMES):
+		print(f"Method out of range (0-{len(METHOD_NAMES)-1})")
+		return False
 	print("Transparent: " + ("YES" if transp else "NO"))
+	print(f"Method: {METHOD_NAMES[method]}" + (" (weighted)" if weighted else ""))
 	num_colors_quant = palette_size - (1 if transp else 0)
 	
-	# Read input data
-	try:
-		img = Image.open(im_in).convert("RGBA")
-	except Exception as e:
-		print("Error opening image")
-		return False
-	
-	# Gather only the opaque colors
-	
-	# Separate alpha out, set transparent pixels to the average opaque color (hacky)
-	if transp:
-		img_px = img.load()
-		opaque_pixels = []
-		for x in range(img.width):
-			for y in range(img.height):
-				r,g,b,a = img_px[x,y]
-				if a >= 128:
-					opaque_pixels.append((r,g,b))
-		if len(opaque_pixels) == img.width*img.height:
-			img_colors = img.convert("RGB")
+	# Read input data and count colors of all images together
+	# With transparency only opaque pixels count, otherwise images are composited over white
+	img_colors = []
+	for im_in in ims_in:
+		try:
+			img = Image.open(im_in).convert("RGBA")
+		except Exception as e:
+			print(f"Error opening image {im_in}")
+			return False
+		if transp:
+			img_rgba = np.asarray(img)
+			img_colors.append(img_rgba[img_rgba[...,3] >= 128][:,:3])
 		else:
-			img_colors = Image.new("RGB", (len(opaque_pixels), 1))
-			img_colors.putdata(opaque_pixels)
-	else:
-		bgcol = (255,255,255,255)
-		img_colors = Image.alpha_composite(Image.new("RGBA", img.size, bgcol), img).convert("RGB")
-	
-	# Reduce to RGB555 and quantize, add 1 so we can differentiate existing colors in palette
-	img_quantized = img_colors.copy()
-	img_quantized_px = img_quantized.load()
-	for x in range(img_colors.width):
-		for y in range(img_colors.height):
-			r5, g5, b5 = col2rgb(rgb2col(img_quantized_px[x,y],255),31)
-			img_quantized_px[x,y] = (r5+1,g5+1,b5+1)
-	#img_quantized = img_quantized.convert('P', palette=Image.Palette.ADAPTIVE, dither=Image.Dither.NONE, colors=num_colors_quant)
-	img_quantized = img_quantized.quantize(colors=num_colors_quant, method=Image.Quantize.MAXCOVERAGE, dither=Image.Dither.NONE)
-	quant_palette = img_quantized.getpalette()[:num_colors_quant*3]
+			bgcol = (255,255,255,255)
+			img_colors.append(np.asarray(Image.alpha_composite(Image.new("RGBA", img.size, bgcol), img).convert("RGB")))
+	hist = color_histogram(img_colors)
+	print(f"Found {np.count_nonzero(hist)} RGB555 colors in {len(ims_in)} image(s)")
 	
-	# Pick out only unique colors
-	actual_num_colors_quant = 0
-	quant_palette_set = set()
-	for i in range(num_colors_quant):
-		c = tuple(quant_palette[i*3:i*3+3])
-		if c != (0,0,0):
-			r5, g5, b5 = c
-			quant_palette_set.add((r5-1, g5-1, b5-1))
-	
-	# Sort colors approximately by brightness
-	quant_palette = sorted(list(quant_palette_set), key=lambda x: (x[0]*2 + x[1]*4 + x[2]*1))
+	# Quantize in RGB555 space
+	quant_palette = derive_palette(hist, num_colors_quant, method, iterations, PERCEPTUAL_WEIGHTS if weighted else None)
 	num_colors_quant = len(quant_palette)
 	if num_colors_quant < 1:
-		raise ValueError("pal empty after quant should not happen")
+		print("No opaque pixels to derive a palette from")
+		return False
+	
+	# Sort colors approximately by brightness
+	quant_palette = sorted(quant_palette.tolist(), key=lambda c: ((c>>10)&31)*2 + ((c>>5)&31)*4 + (c&31))
 	print(f"Quantized to {num_colors_quant} colors")
 	
-	# Extract RGB555 palette, subtracting the 1 we added before
+	# Color 0 is left black for transparency, as are any unused colors
 	default_color = rgb2col((0,0,0), 31)
 	data_palette = [default_color]*palette_size
 	for i in range(num_colors_quant):
-		c = quant_palette[i]
-		cl = rgb2col(c, 31)
-		data_palette[(i+1) if transp else i] = cl
+		data_palette[(i+1) if transp else i] = quant_palette[i]
 	
 	# Write output data
 	print(f"Saving palette to {res_pal_out}")
@@ -122,3 +105,4 @@ def cmd_derive_palette(args):
 	data_palette = struct.pack(f">H{palette_size}H", palette_size, *data_palette)
 	with open(res_pal_out, "wb") as f:
 		f.write(data_palette)
+	return True
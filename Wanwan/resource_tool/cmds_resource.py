@@ -1,80 +1,264 @@
+import csv
+import hashlib
+import json
+import os
 import struct
+from util import parsebool
 from util import check_files, make_dirs_for_file, paths_equivalent
-from lzss_ww import compress, decompress
+from util import map_file, is_filled, strip_fill, write_fill
+from lzss_ww import decompress, probe, LzssDecompressor, compress_many, decompress_many, LEVEL_NAMES
+from lzss_cache import compress_cached, compress_many_cached
+from resource_section import *
 
-ROM_BASE = 0x0E000000
-RESOURCES_SECTION_PTR = 0x70000
-RESOURCES_SECTION_DEFAULT_MAX = 0x200000-RESOURCES_SECTION_PTR
-RESOURCES_SECTION_HARD_LIMIT = 0x400000-RESOURCES_SECTION_PTR
-SECTION_PAD_VALUE = 0xFF
-ROM_PAD_VALUE = 0xFF
-
-def _get_res_count_table(sec_data):
-	# Load count and table, ensure input is sane
-	if len(sec_data) < 4:
-		print("Size too small, can't read resource count")
-		return None
-	res_count = struct.unpack(">I", sec_data[:4])[0]
-	if 4+(res_count*4) > len(sec_data):
-		print("Size too small, can't read resource table")
-		return None
-	res_table = struct.unpack(f">{res_count}I", sec_data[4:4+(res_count*4)])
-	
-	# Validate input size contains at least the start address for all resources
-	max_ptr = max(0, max(res_table)-ROM_BASE-RESOURCES_SECTION_PTR)
-	if max_ptr >= len(sec_data):
-		print("Size too small, some pointers are excluded")
+def _build_section(resources, max_size):
+	# Lay out the pointer table and 4-byte padded data, with null entries for missing resources
+	# Identical resources are stored once and share a pointer
+	res_count = len(resources)
+	current_ptr = ROM_BASE+RESOURCES_SECTION_PTR+4+(res_count*4)
+	res_table = [0]*res_count
+	res_ptrs = {}
+	dupe_count = 0
+	dupe_size = 0
+	sec_data = bytearray()
+	for i in range(res_count):
+		if resources[i] == None or len(resources[i]) == 0:
+			continue
+		rdata = bytes(resources[i])
+		rlen = len(rdata)
+		if (rlen&3) != 0:
+			pad = 4 - (rlen&3)
+			rdata = rdata + bytes([SECTION_PAD_VALUE]*pad)
+			rlen += pad
+		res_hash = hashlib.blake2b(rdata, digest_size=20).digest()
+		if res_hash in res_ptrs:
+			res_table[i] = res_ptrs[res_hash]
+			dupe_count += 1
+			dupe_size += rlen
+			continue
+		sec_data.extend(rdata)
+		res_table[i] = current_ptr
+		res_ptrs[res_hash] = current_ptr
+		current_ptr += rlen
+	if dupe_count > 0:
+		print(f"Deduplicated {dupe_count} resources, saving {dupe_size} bytes")
+	if 4+(res_count*4)+len(sec_data) > max_size:
+		print("Modified section exceeds max size!")
 		return None
-	
-	return (res_count, res_table)
+	return struct.pack(">I", res_count) + struct.pack(f">{res_count}I", *res_table) + sec_data
 
-def _get_res_ptr_size(sec_data, res_count, res_table, res_index):
-	# Get resource pointer
-	if res_index < 0 or res_index >= res_count:
-		print(f"Resource {res_index} out of range (0-{res_count-1})")
+def _patch_shift(section, res_index, res_data):
+	# How far the resources after this one must move for the new data to fill the slot exactly
+	# The shift is negative when the new data is smaller, so no slack is left behind the resource
+	new_size = (len(res_data)+3) & ~3
+	shift = new_size-section.size(res_index)
+	if shift <= 0 and shift > -4:
+		return 0
+	return (shift+3) & ~3
+
+def _patch_resource(sec_path, section, res_index, res_data, max_size):
+	# Replace one resource directly in the section file, writing as little as possible
+	# If the new data fills the old slot, only the slot is overwritten
+	# Otherwise the resources after it are shifted up or down and only their pointer entries are rewritten
+	# returns the number of bytes written, or None if the section would exceed max_size
+	res_offset = section.offset(res_index)
+	res_ptr = section.ptr(res_index)
+	slot_size = section.size(res_index)
+	slot_end = res_offset+slot_size
+	shift = _patch_shift(section, res_index, res_data)
+	if len(section.data)+shift > max_size:
+		print("Modified section exceeds max size!")
 		return None
-	res_ptr = res_table[res_index]
-	if res_ptr < ROM_BASE+RESOURCES_SECTION_PTR:
-		res_ptr = 0
-	
-	# Calculate resource size
-	res_size = 0
-	if res_ptr != 0:
-		next_ptr = min([p for p in res_table if p > res_ptr], default=None)
-		if not next_ptr:
-			res_offset = res_ptr - (ROM_BASE+RESOURCES_SECTION_PTR)
-			res_size = len(sec_data) - res_offset
-		else:
-			res_size = next_ptr - res_ptr
 	
-	return (res_ptr, res_size)
+	# Copy whatever has to move before anything is overwritten
+	tail_data = bytes(section.data[slot_end:]) if shift != 0 else b""
+	_release_section(section)
+	written = 0
+	with open(sec_path, "r+b") as sec:
+		sec.seek(section.base+res_offset)
+		sec.write(res_data)
+		write_fill(sec, SECTION_PAD_VALUE, slot_size+shift-len(res_data))
+		written += slot_size+shift
+		if shift != 0:
+			sec.write(tail_data)
+			written += len(tail_data)
+			# A section file ends with the section, inside a ROM the space freed goes back to ROM padding
+			if shift < 0 and section.base == 0:
+				sec.truncate()
+			elif shift < 0:
+				write_fill(sec, ROM_PAD_VALUE, -shift)
+				written -= shift
+			for i, p in enumerate(section.table):
+				if p > res_ptr:
+					sec.seek(section.base+4+i*4)
+					sec.write(struct.pack(">I", p+shift))
+					written += 4
+	return written
+
+MANIFEST_FIELDS = ["index", "file", "offset", "size", "padded_size", "compressed", "decompressed_size", "compress", "hash", "type"]
+INDEX_FIELDS = ["index", "offset", "size", "padded_size", "compressed", "decompressed_size", "hash", "type"]
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+DELTA_MAGIC = b"WWDL"
+DELTA_VERSION = 2
+# Magic, version, old and new file hashes, new file size, new section size, size of the table before the first slot
+DELTA_HEADER = ">4sB20s20sIII"
+DELTA_CHUNK_SIZE = 256
+DELTA_SLOT_COPY = 0
+DELTA_SLOT_RAW = 1
+DELTA_SLOT_LZSS = 2
+
+def _hash_resource(res_data):
+	return hashlib.blake2b(res_data, digest_size=20).hexdigest()
+
+def _save_manifest(path, entries):
+	# Save manifest entries as CSV or JSON depending on the file extension
+	if path.lower().endswith(".csv"):
+		with open(path, "w", newline="") as f:
+			writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+			writer.writeheader()
+			writer.writerows(entries)
+	else:
+		with open(path, "w") as f:
+			json.dump(entries, f, indent="\t")
 
-def _read_one_resource(sec_data, res_count, res_table, res_index):
-	# Locate the resource
-	res_ptr_size = _get_res_ptr_size(sec_data, res_count, res_table, res_index)
-	if not res_ptr_size:
+def _describe_resource(section, res_index):
+	# Probe one resource for the section index
+	res_data = section[res_index]
+	entry = dict.fromkeys(INDEX_FIELDS, None)
+	entry["index"] = res_index
+	if res_data == None:
+		return entry
+	entry["offset"] = section.offset(res_index)
+	entry["size"] = len(res_data)
+	entry["padded_size"] = len(res_data)
+	entry["hash"] = _hash_resource(res_data)
+	comp_sizes = find_compressed_stream(res_data)
+	entry["compressed"] = comp_sizes != None
+	if comp_sizes != None:
+		entry["size"], entry["decompressed_size"] = comp_sizes
+		header = LzssDecompressor().decompress(res_data, max_length=5)
+		entry["type"] = guess_resource_type(header or b"", entry["decompressed_size"], True)
+	else:
+		entry["type"] = guess_resource_type(res_data[:5], len(res_data), False)
+	return entry
+
+def _load_section_index(sec_path):
+	# Load the index saved next to a section, returns a dict of entries by hash, empty if there is no usable index
+	try:
+		with open(sec_path+INDEX_SUFFIX, "r") as f:
+			index = json.load(f)
+		if index.get("version") != INDEX_VERSION:
+			return {}
+		return {e["hash"]: e for e in index["resources"] if e["hash"]}
+	except (OSError, ValueError, KeyError, TypeError, AttributeError):
+		return {}
+
+def _describe_section(section, sec_path=None):
+	# Describe every resource, reusing the saved index for any resource whose hash is unchanged
+	known = _load_section_index(sec_path) if sec_path else {}
+	reused = 0
+	entries = []
+	for res_index in range(len(section)):
+		res_data = section[res_index]
+		if res_data != None and known:
+			res_hash = _hash_resource(res_data)
+			if res_hash in known:
+				entry = dict(known[res_hash])
+				entry["index"] = res_index
+				entry["offset"] = section.offset(res_index)
+				entries.append(entry)
+				reused += 1
+				continue
+		entries.append(_describe_resource(section, res_index))
+	if reused > 0:
+		print(f"Reused saved index for {reused} resources")
+	return entries
+
+def _section_resources(section, entries):
+	# Read every resource for a rebuild, with compressed streams cut to their length
+	# Resources patched in-place by older versions can be followed by more padding than the alignment
+	resources = section.resources()
+	for entry in entries:
+		if entry["compressed"]:
+			resources[entry["index"]] = resources[entry["index"]][:entry["size"]]
+	return resources
+
+def _load_manifest(path):
+	# Load manifest entries from CSV or JSON depending on the file extension
+	# returns a list of entries with at least index, file and compress, or None after printing the problem
+	try:
+		if path.lower().endswith(".csv"):
+			with open(path, "r", newline="") as f:
+				entries = list(csv.DictReader(f))
+		else:
+			with open(path, "r") as f:
+				entries = json.load(f)
+		for entry in entries:
+			entry["index"] = int(entry["index"])
+			entry["file"] = entry.get("file") or ""
+			comp = entry.get("compress") or False
+			entry["compress"] = parsebool(comp) if type(comp) == str else bool(comp)
+	except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+		print(f"Can't read manifest: {e}")
 		return None
-	res_ptr, res_size = res_ptr_size
-	if res_ptr == 0:
-		print(f"Resource {res_index} is null")
+	return entries
+
+def _load_section(path):
+	# Map a section file, or the section inside a ROM with its size detected
+	# returns a ResourceSection, or None after printing the problem
+	data = map_file(path)
+	if not is_rom(data):
+		return ResourceSection.parse(data)
+	sec_size = find_section_size(data)
+	if sec_size == None:
+		print("Can't locate resource section in ROM")
 		return None
-	# Read the data
-	res_offset = res_ptr - (ROM_BASE+RESOURCES_SECTION_PTR)
-	res_data = sec_data[res_offset:res_offset+res_size]
-	return res_data
+	print(f"Detected resource section in ROM (0x{sec_size:06X} bytes)")
+	return ResourceSection.parse(data[RESOURCES_SECTION_PTR:RESOURCES_SECTION_PTR+sec_size], RESOURCES_SECTION_PTR)
 
-def _read_all_resources(sec_data, res_count, res_table):
-	resources = [None]*res_count
-	for res_index in range(res_count):
-		# Locate the resource
-		res_ptr, res_size = _get_res_ptr_size(sec_data, res_count, res_table, res_index)
-		if res_ptr == 0:
-			continue
-		# Read the data
-		res_offset = res_ptr - (ROM_BASE+RESOURCES_SECTION_PTR)
-		res_data = sec_data[res_offset:res_offset+res_size]
-		resources[res_index] = res_data
-	return resources
+def _release_section(section, views=()):
+	# Release the mapped section data and any views of it, so its file can be rewritten or truncated
+	# Truncating a mapped file fails on Windows, and reading a view past the new end of the file crashes elsewhere
+	for view in views:
+		if isinstance(view, memoryview):
+			view.release()
+	section.data.release()
+
+def _write_rom(rom_data, rom_size, rom_out, sec_data, align=4096, shrink=False):
+	# Write a ROM with a new section, growing and aligning as needed
+	# rom_data is None when writing in-place, then only the section and padding are rewritten
+	new_rom_size = RESOURCES_SECTION_PTR+len(sec_data)
+	if new_rom_size < rom_size and not shrink:
+		# Grow the ROM to at least the old size
+		print("Growing to match input ROM size (pass --shrink true to skip)")
+		new_rom_size = rom_size
+	if (new_rom_size % align) != 0:
+		# Pad the ROM to alignment
+		print(f"Aligning end to {align} bytes")
+		new_rom_size += align - (new_rom_size % align)
+	
+	# Preallocate the file and fill the padding after the section
+	print(f"Saving modified ROM to {rom_out}")
+	make_dirs_for_file(rom_out)
+	with open(rom_out, "r+b" if rom_data == None else "wb") as rom:
+		rom.truncate(new_rom_size)
+		if rom_data != None:
+			rom.write(rom_data[:RESOURCES_SECTION_PTR])
+		rom.seek(RESOURCES_SECTION_PTR)
+		rom.write(sec_data)
+		write_fill(rom, ROM_PAD_VALUE, new_rom_size-rom.tell())
+
+def _save_section(section, sec_in, sec_out, sec_data, inplace):
+	# Save a rebuilt section, into a copy of the input ROM if it came from one
+	if section.base == 0:
+		print(f"Saving modified section to {sec_out}")
+		make_dirs_for_file(sec_out)
+		with open(sec_out, "wb") as sec:
+			sec.write(sec_data)
+		return
+	rom_size = os.path.getsize(sec_in)
+	rom_data = None if inplace else map_file(sec_in)
+	_write_rom(rom_data, rom_size, sec_out, sec_data)
 
 def cmd_extract_sec(args):
 	# Parse and verify command arguments
@@ -83,23 +267,27 @@ def cmd_extract_sec(args):
 	sec_size = args.sec_size
 	if not check_files(exist=[rom_in], noexist=[sec_out]):
 		return False
-	if sec_size <= 0:
+	if sec_size == 0 or sec_size < -1:
 		print("Invalid size")
 		return False
 	
 	# Read input data
 	print("Loading input data")
-	with open(rom_in, "rb") as rom:
-		rom.seek(RESOURCES_SECTION_PTR)
-		sec_data = rom.read(sec_size)
-		post_data = rom.read()
+	rom_data = map_file(rom_in)
+	if sec_size == -1:
+		sec_size = find_section_size(rom_data)
+		if sec_size == None:
+			print("Can't locate resource section in ROM")
+			return False
+		print(f"Detected section size 0x{sec_size:06X}")
+	sec_data = rom_data[RESOURCES_SECTION_PTR:RESOURCES_SECTION_PTR+sec_size]
+	post_data = rom_data[RESOURCES_SECTION_PTR+sec_size:]
 	
 	print("Validating size")
 	# Validate that the remaining data contains only FF
-	for b in post_data:
-		if b != ROM_PAD_VALUE:
-			print("Size too small, some data after end")
-			return False
+	if not is_filled(post_data, ROM_PAD_VALUE):
+		print("Size too small, some data after end")
+		return False
 	# Warn if the data has too many FFs at the end
 	check_ff_count = 5
 	for i in range(check_ff_count):
@@ -110,8 +298,7 @@ def cmd_extract_sec(args):
 	
 	# Load section data for validation
 	print("Validating section data")
-	res_count_table = _get_res_count_table(sec_data)
-	if res_count_table == None:
+	if ResourceSection.parse(sec_data) == None:
 		return False
 	
 	# Write output data
@@ -140,12 +327,10 @@ def cmd_inject_sec(args):
 	
 	# Read input data
 	print("Loading input data")
-	with open(rom_in, "rb") as rom:
-		rom_data = rom.read()
-		rom_size = len(rom_data)
-	with open(sec_in, "rb") as sec:
-		sec_data = sec.read()
-	if rom_size > 0x400000 or rom_data[:4] != b"\x0E\x00\x00\x80":
+	rom_data = map_file(rom_in)
+	rom_size = len(rom_data)
+	sec_data = map_file(sec_in)
+	if rom_size > 0x400000 or rom_data[:4] != ROM_MAGIC:
 		print("Not a valid ROM!")
 		return False
 	if len(sec_data) > RESOURCES_SECTION_HARD_LIMIT:
@@ -154,32 +339,15 @@ def cmd_inject_sec(args):
 	
 	# Load section data for validation
 	print("Validating section file")
-	res_count_table = _get_res_count_table(sec_data)
-	if res_count_table == None:
+	if ResourceSection.parse(sec_data) == None:
 		return False
 	
 	# Inject section into ROM
 	print("Injecting new section")
-	rom_data = rom_data[:RESOURCES_SECTION_PTR] + sec_data
-	new_rom_size = len(rom_data)
-	if new_rom_size < rom_size and not shrink:
-		# Grow the ROM to at least the old size
-		print("Growing to match input ROM size (pass --shrink true to skip)")
-		diff = rom_size - new_rom_size
-		rom_data += bytes([ROM_PAD_VALUE]*diff)
-		new_rom_size += diff
-	if (new_rom_size % align) != 0:
-		# Pad the ROM to alignment
-		print(f"Aligning end to {align} bytes")
-		diff = align - (new_rom_size % align)
-		rom_data += bytes([ROM_PAD_VALUE]*diff)
-		new_rom_size += diff
-	
-	# Write output data
-	print(f"Saving modified ROM to {rom_out}")
-	make_dirs_for_file(rom_out)
-	with open(rom_out, "wb") as rom:
-		rom.write(rom_data)
+	if inplace:
+		rom_data.release()
+		rom_data = None
+	_write_rom(rom_data, rom_size, rom_out, sec_data, align, shrink)
 	return True
 
 def cmd_extract_res(args):
@@ -191,26 +359,32 @@ def cmd_extract_res(args):
 	if not check_files(exist=[sec_in], noexist=[res_out]):
 		return False
 	
-	# Read input data
-	print("Loading input data")
-	with open(sec_in, "rb") as sec:
-		sec_data = sec.read()
-	
 	# Load and validate section data
 	print("Reading section file")
-	res_count_table = _get_res_count_table(sec_data)
-	if res_count_table == None:
+	section = _load_section(sec_in)
+	if section == None:
 		return False
-	res_count, res_table = res_count_table
 	
 	# Read resource and decompress if requested
 	print(f"Reading resource {res_index}")
-	res_data = _read_one_resource(sec_data, res_count, res_table, res_index)
+	if not section.in_range(res_index):
+		print(f"Resource {res_index} out of range (0-{len(section)-1})")
+		return False
+	res_data = section[res_index]
+	if res_data == None:
+		print(f"Resource {res_index} is null")
+		return False
 	if comp:
-		res_data = decompress(res_data)
-		if not res_data:
+		res_probe = probe(res_data)
+		if not res_probe:
+			print("Resource is not a valid compressed stream")
 			return False
-		print(f"Decompressed {len(res_data)} bytes")
+		comp_size, decomp_size, _ = res_probe
+		pad_size = len(res_data)-comp_size
+		res_data = decompress(res_data, output_size=decomp_size)
+		if res_data == None:
+			return False
+		print(f"Decompressed {len(res_data)} bytes from {comp_size} bytes ({pad_size} bytes padding)")
 	
 	# Write output data
 	print(f"Saving resource to {res_out}")
@@ -227,6 +401,8 @@ def cmd_inject_res(args):
 	sec_out = args.path_sec_out
 	max_size = args.max_size
 	comp = args.compressed
+	level = args.level
+	cache = args.cache
 	inplace = False
 	if sec_out == "@":
 		sec_out = sec_in
@@ -243,20 +419,21 @@ def cmd_inject_res(args):
 	elif max_size <= 0 or max_size > RESOURCES_SECTION_HARD_LIMIT:
 		print(f"Max size out of range (0x000001-0x{RESOURCES_SECTION_HARD_LIMIT:06X})")
 		return False
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
 	
 	# Read input data
 	print("Loading input data")
-	with open(sec_in, "rb") as sec:
-		sec_data = sec.read()
 	with open(res_in, "rb") as res:
 		res_data = res.read()
 	
 	# Load and validate section data
 	print("Validating section file")
-	res_count_table = _get_res_count_table(sec_data)
-	if res_count_table == None:
+	section = _load_section(sec_in)
+	if section == None:
 		return False
-	res_count, res_table = res_count_table
+	res_count = len(section)
 
 	append = False
 	if res_index == -1:
@@ -265,17 +442,30 @@ def cmd_inject_res(args):
 		print(f"Resource {res_index} out of range (0-{res_count-1})")
 		return False
 	
-	# Read all existing resources
-	print("Reading existing resources")
-	resources = _read_all_resources(sec_data, res_count, res_table)
-	
-	# Replace the target, compressing if requested
+	# Compress if requested
 	print("Injecting new resource")
 	if comp:
-		res_data = compress(res_data)
+		res_data = compress_cached(res_data, level, cache)
 		if not res_data:
 			return False
-		print(f"Compressed {len(res_data)} bytes")
+		print(f"Compressed {len(res_data)} bytes ({LEVEL_NAMES[level]})")
+	
+	# Patch the existing file when possible
+	# Null, shared or newly emptied slots change the pointer table so they need a full rebuild
+	# A section inside a ROM can only grow into the padding already at the end of the ROM
+	patchable = not append and len(res_data) > 0 and not section.is_null(res_index) and section.table.count(section.table[res_index]) == 1
+	if patchable and section.base != 0:
+		patchable = section.base+len(section.data)+_patch_shift(section, res_index, res_data) <= os.path.getsize(sec_in)
+	if inplace and patchable:
+		written = _patch_resource(sec_out, section, res_index, res_data, max_size)
+		if written == None:
+			return False
+		print(f"Replaced resource {res_index} in-place ({written} bytes written)")
+		return True
+	
+	# Read all existing resources
+	print("Reading existing resources")
+	resources = _section_resources(section, _describe_section(section, sec_in))
 	if append:
 		resources.append(res_data)
 		print(f"Appended at resource {res_count}")
@@ -286,29 +476,559 @@ def cmd_inject_res(args):
 	
 	# Create new pointer table and padded data
 	print("Building new section")
-	current_ptr = ROM_BASE+RESOURCES_SECTION_PTR+4+(res_count*4)
-	res_table = [0]*res_count
-	sec_data = bytearray()
-	for i in range(res_count):
-		if resources[i] == None or len(resources[i]) == 0:
+	sec_data = _build_section(resources, max_size)
+	if sec_data == None:
+		return False
+	
+	# Write output data
+	_release_section(section, resources)
+	_save_section(section, sec_in, sec_out, sec_data, inplace)
+	return True
+
+def cmd_recompress_sec(args):
+	# Parse and verify command arguments
+	sec_in = args.path_sec_in
+	sec_out = args.path_sec_out
+	max_size = args.max_size
+	level = args.level
+	workers = args.workers
+	inplace = False
+	if sec_out == "@":
+		sec_out = sec_in
+		inplace = True
+	if not check_files(exist=[sec_in], noexist=[] if inplace else [sec_out]):
+		if paths_equivalent(sec_in, sec_out) and not inplace:
+			print("Specify \"@\" as the output file to recompress in-place")
+		return False
+	if max_size == -1:
+		max_size = RESOURCES_SECTION_DEFAULT_MAX
+	elif max_size <= 0 or max_size > RESOURCES_SECTION_HARD_LIMIT:
+		print(f"Max size out of range (0x000001-0x{RESOURCES_SECTION_HARD_LIMIT:06X})")
+		return False
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
+	if workers == -1:
+		workers = None
+	elif workers <= 0:
+		print("Invalid worker count")
+		return False
+	
+	# Load and validate section data
+	print("Validating section file")
+	section = _load_section(sec_in)
+	if section == None:
+		return False
+	
+	# Find every compressed resource
+	print("Detecting compressed resources")
+	entries = _describe_section(section, sec_in)
+	resources = _section_resources(section, entries)
+	comp_indices = [e["index"] for e in entries if e["compressed"]]
+	comp_streams = [resources[i] for i in comp_indices]
+	print(f"Found {len(comp_indices)} compressed resources")
+	
+	# Decompress, recompress and verify
+	print(f"Recompressing ({LEVEL_NAMES[level]})")
+	decomp_streams = decompress_many(comp_streams, workers)
+	new_streams = compress_many(decomp_streams, workers, level)
+	check_streams = decompress_many(new_streams, workers)
+	
+	# Keep whichever stream is smaller for each resource
+	total_saved = 0
+	for i, res_index in enumerate(comp_indices):
+		if check_streams[i] != decomp_streams[i]:
+			print(f"Resource {res_index}: round-trip verification failed!")
+			return False
+		old_size = (len(resources[res_index])+3) & ~3
+		new_size = (len(new_streams[i])+3) & ~3
+		if new_size >= old_size:
 			continue
-		rdata = bytes(resources[i])
-		rlen = len(rdata)
-		if (rlen&3) != 0:
-			pad = 4 - (rlen&3)
-			rdata = rdata + bytes([SECTION_PAD_VALUE]*pad)
-			rlen += pad
-		sec_data.extend(rdata)
-		res_table[i] = current_ptr
-		current_ptr += rlen
-	if 4+(res_count*4)+len(sec_data) > max_size:
-		print("Modified section exceeds max size!")
+		resources[res_index] = new_streams[i]
+		total_saved += old_size-new_size
+		print(f"Resource {res_index}: {old_size} -> {new_size} bytes ({old_size-new_size} reclaimed)")
+	
+	# Rebuild the section
+	print("Building new section")
+	new_sec_data = _build_section(resources, max_size)
+	if new_sec_data == None:
+		return False
+	print(f"Reclaimed {total_saved} bytes in total ({len(section.data)} -> {len(new_sec_data)} bytes)")
+	
+	# Write output data
+	_release_section(section, resources+comp_streams)
+	_save_section(section, sec_in, sec_out, new_sec_data, inplace)
+	return True
+
+def cmd_extract_all(args):
+	# Parse and verify command arguments
+	sec_in = args.path_sec_in
+	out_dir = args.path_out_dir
+	comp = args.compressed
+	manifest_out = args.manifest
+	workers = args.workers
+	if manifest_out == None:
+		manifest_out = os.path.join(out_dir, "manifest.json")
+	if not check_files(exist=[sec_in], noexist=[manifest_out]):
+		return False
+	if workers == -1:
+		workers = None
+	elif workers <= 0:
+		print("Invalid worker count")
+		return False
+	
+	# Load and validate section data
+	print("Reading section file")
+	section = _load_section(sec_in)
+	if section == None:
+		return False
+	
+	# Describe every resource, detecting compressed streams
+	# File paths in the manifest are relative to the manifest, as build-section expects
+	print(f"Reading {len(section)} resources")
+	manifest_dir = os.path.dirname(os.path.abspath(manifest_out))
+	entries = []
+	out_paths = {}
+	comp_indices = []
+	for desc in _describe_section(section, sec_in):
+		entry = dict.fromkeys(MANIFEST_FIELDS, None)
+		entry.update(desc)
+		entry["file"] = ""
+		entries.append(entry)
+		if desc["offset"] == None:
+			continue
+		out_paths[entry["index"]] = os.path.join(out_dir, f"{entry['index']:04d}.bin")
+		entry["file"] = os.path.relpath(out_paths[entry["index"]], manifest_dir)
+		entry["compress"] = False
+		if entry["compressed"]:
+			comp_indices.append(entry["index"])
+	
+	# Check nothing will be overwritten
+	if not check_files(exist=[], noexist=list(out_paths.values())):
+		return False
+	
+	# Decompress everything in one batch if requested
+	resources = _section_resources(section, entries)
+	res_out = {}
+	if comp:
+		print(f"Decompressing {len(comp_indices)} resources")
+		comp_streams = [resources[i] for i in comp_indices]
+		decomp_streams = decompress_many(comp_streams, workers)
+		for res_index, decomp_data in zip(comp_indices, decomp_streams):
+			if decomp_data == None:
+				return False
+			entries[res_index]["compress"] = True
+			res_out[res_index] = decomp_data
+	
+	# Write output data
+	print(f"Saving resources to {out_dir}")
+	os.makedirs(out_dir, exist_ok=True)
+	for res_index, res_path in out_paths.items():
+		res_data = res_out.get(res_index, resources[res_index])
+		with open(res_path, "wb") as res:
+			res.write(res_data)
+	print(f"Saving manifest to {manifest_out}")
+	make_dirs_for_file(manifest_out)
+	_save_manifest(manifest_out, entries)
+	return True
+
+def cmd_build_sec(args):
+	# Parse and verify command arguments
+	manifest_in = args.path_manifest_in
+	sec_out = args.path_sec_out
+	max_size = args.max_size
+	level = args.level
+	cache = args.cache
+	workers = args.workers
+	if not check_files(exist=[manifest_in], noexist=[sec_out]):
+		return False
+	if max_size == -1:
+		max_size = RESOURCES_SECTION_DEFAULT_MAX
+	elif max_size <= 0 or max_size > RESOURCES_SECTION_HARD_LIMIT:
+		print(f"Max size out of range (0x000001-0x{RESOURCES_SECTION_HARD_LIMIT:06X})")
+		return False
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
+	if workers == -1:
+		workers = None
+	elif workers <= 0:
+		print("Invalid worker count")
+		return False
+	
+	# Load and validate the manifest, file paths are relative to it
+	print("Loading manifest")
+	entries = _load_manifest(manifest_in)
+	if entries == None:
+		return False
+	res_count = max([e["index"] for e in entries], default=-1)+1
+	base_dir = os.path.dirname(os.path.abspath(manifest_in))
+	res_paths = [None]*res_count
+	res_comp = [False]*res_count
+	for entry in entries:
+		res_index = entry["index"]
+		if res_index < 0:
+			print(f"Resource {res_index} out of range")
+			return False
+		if res_paths[res_index] != None:
+			print(f"Resource {res_index} listed more than once")
+			return False
+		res_paths[res_index] = os.path.join(base_dir, entry["file"]) if entry["file"] else ""
+		res_comp[res_index] = entry["compress"]
+	if not check_files(exist=[p for p in res_paths if p], noexist=[]):
+		return False
+	
+	# Read input data
+	print(f"Loading {res_count} resources")
+	resources = [None]*res_count
+	for res_index in range(res_count):
+		if not res_paths[res_index]:
+			continue
+		with open(res_paths[res_index], "rb") as res:
+			resources[res_index] = res.read()
+	
+	# Compress everything that needs it in one batch
+	comp_indices = [i for i in range(res_count) if res_comp[i] and resources[i]]
+	print(f"Compressing {len(comp_indices)} resources ({LEVEL_NAMES[level]})")
+	comp_data = compress_many_cached([resources[i] for i in comp_indices], level, cache, workers)
+	for res_index, res_data in zip(comp_indices, comp_data):
+		resources[res_index] = res_data
+	
+	# Create pointer table and padded data
+	print("Building new section")
+	sec_data = _build_section(resources, max_size)
+	if sec_data == None:
 		return False
 	
 	# Write output data
-	print(f"Saving modified section to {sec_out}")
+	print(f"Saving section to {sec_out}")
+	make_dirs_for_file(sec_out)
 	with open(sec_out, "wb") as sec:
-		sec.write(struct.pack(">I", res_count))
-		sec.write(struct.pack(f">{res_count}I", *res_table))
 		sec.write(sec_data)
 	return True
+
+def cmd_index_sec(args):
+	# Parse and verify command arguments
+	sec_in = args.path_sec_in
+	index_out = args.path_index_out
+	if index_out == None:
+		index_out = sec_in+INDEX_SUFFIX
+	if not check_files(exist=[sec_in], noexist=[]):
+		return False
+	
+	# Load and validate section data
+	print("Reading section file")
+	section = _load_section(sec_in)
+	if section == None:
+		return False
+	
+	# Probe every resource, the existing index is ignored so everything is checked again
+	print(f"Indexing {len(section)} resources")
+	entries = [_describe_resource(section, i) for i in range(len(section))]
+	type_counts = {}
+	for entry in entries:
+		if entry["type"] != None:
+			type_counts[entry["type"]] = type_counts.get(entry["type"], 0)+1
+	for res_type, count in sorted(type_counts.items()):
+		print(f"{res_type}: {count}")
+	
+	# Write output data
+	print(f"Saving index to {index_out}")
+	make_dirs_for_file(index_out)
+	with open(index_out, "w") as f:
+		json.dump({"version": INDEX_VERSION, "resources": entries}, f, indent="\t")
+	return True
+
+def cmd_diff_sec(args):
+	# Parse and verify command arguments
+	sec_a = args.path_sec_a
+	sec_b = args.path_sec_b
+	decomp = args.decompressed
+	workers = args.workers
+	if not check_files(exist=[sec_a, sec_b], noexist=[]):
+		return False
+	if workers == -1:
+		workers = None
+	elif workers <= 0:
+		print("Invalid worker count")
+		return False
+	
+	# Load and validate both sections
+	print("Reading section files")
+	section_a = _load_section(sec_a)
+	if section_a == None:
+		return False
+	section_b = _load_section(sec_b)
+	if section_b == None:
+		return False
+	
+	# Compare each index by hash, ignoring trailing padding
+	# Resources patched in-place can be followed by more padding than a rebuilt section would give them
+	added = []
+	removed = []
+	changed = []
+	for res_index in range(max(len(section_a), len(section_b))):
+		res_a = section_a[res_index] if res_index < len(section_a) else None
+		res_b = section_b[res_index] if res_index < len(section_b) else None
+		if res_a == None and res_b == None:
+			continue
+		if res_a == None:
+			added.append(res_index)
+		elif res_b == None:
+			removed.append(res_index)
+		else:
+			res_a = res_a[:strip_fill(res_a, SECTION_PAD_VALUE)]
+			res_b = res_b[:strip_fill(res_b, SECTION_PAD_VALUE)]
+			if len(res_a) != len(res_b) or _hash_resource(res_a) != _hash_resource(res_b):
+				changed.append(res_index)
+	
+	# Drop changes that are only a different encoding of the same data
+	reencoded = []
+	if decomp and changed:
+		comp_pairs = []
+		for res_index in changed:
+			comp_a = find_compressed_stream(section_a[res_index])
+			comp_b = find_compressed_stream(section_b[res_index])
+			if comp_a != None and comp_b != None and comp_a[1] == comp_b[1]:
+				comp_pairs.append((res_index, section_a[res_index][:comp_a[0]], section_b[res_index][:comp_b[0]]))
+		print(f"Decompressing {len(comp_pairs)} changed resources")
+		decomp_data = decompress_many([p[1] for p in comp_pairs]+[p[2] for p in comp_pairs], workers)
+		for i, pair in enumerate(comp_pairs):
+			if decomp_data[i] != None and decomp_data[i] == decomp_data[len(comp_pairs)+i]:
+				reencoded.append(pair[0])
+		reencoded_set = set(reencoded)
+		changed = [i for i in changed if i not in reencoded_set]
+	
+	# Report differences
+	print()
+	size_delta = 0
+	for res_index in added:
+		res_size = section_b.size(res_index)
+		size_delta += res_size
+		print(f"Added {res_index}: {res_size} bytes")
+	for res_index in removed:
+		res_size = section_a.size(res_index)
+		size_delta -= res_size
+		print(f"Removed {res_index}: {res_size} bytes")
+	for res_index in sorted(changed + reencoded):
+		size_a = section_a.size(res_index)
+		size_b = section_b.size(res_index)
+		size_delta += size_b-size_a
+		label = "Re-encoded" if res_index in reencoded else "Changed"
+		print(f"{label} {res_index}: {size_a} -> {size_b} bytes ({size_b-size_a:+})")
+	print()
+	print(f"{len(added)} added, {len(removed)} removed, {len(changed)} changed" + (f", {len(reencoded)} re-encoded" if decomp else ""))
+	print(f"Section size {len(section_a.data)} -> {len(section_b.data)} bytes ({len(section_b.data)-len(section_a.data):+}), resources {size_delta:+} bytes")
+	return True
+
+def _section_slots(section):
+	# returns the (offset, size) of each distinct resource slot in offset order, and where the first one starts
+	slots = sorted(set((section.offset(i), section.size(i)) for i in range(len(section)) if not section.is_null(i)))
+	data_start = slots[0][0] if slots else len(section.data)
+	return slots, data_start
+
+def _diff_ranges(old_data, new_data):
+	# returns the (offset, size) of each run of DELTA_CHUNK_SIZE chunks that differ between two equal size buffers
+	ranges = []
+	for pos in range(0, len(new_data), DELTA_CHUNK_SIZE):
+		if old_data[pos:pos+DELTA_CHUNK_SIZE] == new_data[pos:pos+DELTA_CHUNK_SIZE]:
+			continue
+		size = min(DELTA_CHUNK_SIZE, len(new_data)-pos)
+		if ranges and ranges[-1][0]+ranges[-1][1] == pos:
+			ranges[-1] = (ranges[-1][0], ranges[-1][1]+size)
+		else:
+			ranges.append((pos, size))
+	return ranges
+
+def cmd_make_delta(args):
+	# Parse and verify command arguments
+	sec_old = args.path_sec_old
+	sec_new = args.path_sec_new
+	delta_out = args.path_delta_out
+	comp = args.compressed
+	level = args.level
+	workers = args.workers
+	if not check_files(exist=[sec_old, sec_new], noexist=[delta_out]):
+		return False
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
+	if workers == -1:
+		workers = None
+	elif workers <= 0:
+		print("Invalid worker count")
+		return False
+	
+	# Load and validate both sections
+	print("Reading section files")
+	section_old = _load_section(sec_old)
+	if section_old == None:
+		return False
+	section_new = _load_section(sec_new)
+	if section_new == None:
+		return False
+	if (section_old.base == 0) != (section_new.base == 0):
+		print("Both inputs must be ROMs, or both sections")
+		return False
+	old_file = map_file(sec_old)
+	new_file = map_file(sec_new)
+	
+	# ROMs keep whatever changed before the section, such as code patches
+	head_ranges = _diff_ranges(old_file[:section_old.base], new_file[:section_new.base])
+	if head_ranges:
+		print(f"{len(head_ranges)} changed ranges before the section ({sum(r[1] for r in head_ranges)} bytes)")
+	
+	# Match each slot of the new section with identical data in the old one
+	print("Comparing resources")
+	old_slots = {}
+	for res_index in range(len(section_old)):
+		if not section_old.is_null(res_index):
+			old_slots.setdefault(_hash_resource(section_old[res_index]), res_index)
+	slots, data_start = _section_slots(section_new)
+	slot_kinds = []
+	slot_data = []
+	for offset, size in slots:
+		res_data = section_new.data[offset:offset+size]
+		old_index = old_slots.get(_hash_resource(res_data), None)
+		if old_index != None:
+			slot_kinds.append(DELTA_SLOT_COPY)
+			slot_data.append(old_index)
+		else:
+			slot_kinds.append(DELTA_SLOT_RAW)
+			slot_data.append(bytes(res_data))
+	new_indices = [i for i in range(len(slots)) if slot_kinds[i] == DELTA_SLOT_RAW]
+	print(f"{len(slots)-len(new_indices)} resources unchanged, {len(new_indices)} stored")
+	
+	# Compress the stored data if requested, keeping whichever is smaller
+	if comp and new_indices:
+		print(f"Compressing {len(new_indices)} resources ({LEVEL_NAMES[level]})")
+		comp_data = compress_many([slot_data[i] for i in new_indices], workers, level)
+		for i, res_comp in zip(new_indices, comp_data):
+			if len(res_comp) < len(slot_data[i]):
+				slot_kinds[i] = DELTA_SLOT_LZSS
+				slot_data[i] = res_comp
+	
+	# Write output data
+	# The pointer table and anything before the first resource are stored verbatim
+	# The hash of the whole new file lets apply-delta check that its output is identical
+	print(f"Saving delta to {delta_out}")
+	make_dirs_for_file(delta_out)
+	with open(delta_out, "wb") as delta:
+		old_hash = hashlib.blake2b(old_file, digest_size=20).digest()
+		new_hash = hashlib.blake2b(new_file, digest_size=20).digest()
+		delta.write(struct.pack(DELTA_HEADER, DELTA_MAGIC, DELTA_VERSION, old_hash, new_hash, len(new_file), len(section_new.data), data_start))
+		delta.write(struct.pack(">I", len(head_ranges)))
+		for offset, size in head_ranges:
+			delta.write(struct.pack(">II", offset, size))
+			delta.write(new_file[offset:offset+size])
+		delta.write(section_new.data[:data_start])
+		delta.write(struct.pack(">I", len(slots)))
+		for kind, data in zip(slot_kinds, slot_data):
+			if kind == DELTA_SLOT_COPY:
+				delta.write(struct.pack(">BI", kind, data))
+			else:
+				delta.write(struct.pack(">BI", kind, len(data)))
+				delta.write(data)
+		print(f"Delta is {delta.tell()} bytes for a {len(new_file)} byte file")
+	return True
+
+def _write_delta(out, old_file, section_old, delta_data):
+	# Write the new file of a delta, from the old file or the delta itself
+	# returns the number of slots, or None after printing the problem
+	ptr = struct.calcsize(DELTA_HEADER)
+	data_start = struct.unpack_from(DELTA_HEADER, delta_data)[6]
+	try:
+		# Everything before the section, with the ranges that changed
+		out.write(old_file[:section_old.base])
+		range_count = struct.unpack(">I", delta_data[ptr:ptr+4])[0]
+		ptr += 4
+		for i in range(range_count):
+			offset, size = struct.unpack(">II", delta_data[ptr:ptr+8])
+			ptr += 8
+			if ptr+size > len(delta_data) or offset+size > section_old.base:
+				raise IndexError
+			out.seek(offset)
+			out.write(delta_data[ptr:ptr+size])
+			ptr += size
+		out.seek(section_old.base)
+		
+		# The pointer table, then every slot
+		if ptr+data_start > len(delta_data):
+			raise IndexError
+		out.write(delta_data[ptr:ptr+data_start])
+		ptr += data_start
+		slot_count = struct.unpack(">I", delta_data[ptr:ptr+4])[0]
+		ptr += 4
+		for i in range(slot_count):
+			kind, value = struct.unpack(">BI", delta_data[ptr:ptr+5])
+			ptr += 5
+			res_data = None
+			if kind == DELTA_SLOT_COPY:
+				if section_old.in_range(value):
+					res_data = section_old[value]
+			elif kind == DELTA_SLOT_RAW or kind == DELTA_SLOT_LZSS:
+				if ptr+value > len(delta_data):
+					raise IndexError
+				res_data = delta_data[ptr:ptr+value]
+				ptr += value
+				if kind == DELTA_SLOT_LZSS:
+					res_data = decompress(res_data)
+			if res_data == None:
+				print(f"Delta slot {i} is invalid")
+				return None
+			out.write(res_data)
+	except (struct.error, IndexError):
+		print("Delta file is truncated")
+		return None
+	return slot_count
+
+def cmd_apply_delta(args):
+	# Parse and verify command arguments
+	sec_old = args.path_sec_old
+	delta_in = args.path_delta_in
+	sec_out = args.path_sec_out
+	if not check_files(exist=[sec_old, delta_in], noexist=[sec_out]):
+		return False
+	
+	# Load and validate the old file and delta
+	print("Reading section file")
+	section_old = _load_section(sec_old)
+	if section_old == None:
+		return False
+	old_file = map_file(sec_old)
+	delta_data = map_file(delta_in)
+	if len(delta_data) < struct.calcsize(DELTA_HEADER) or delta_data[:4] != DELTA_MAGIC or delta_data[4] != DELTA_VERSION:
+		print("Not a valid delta file")
+		return False
+	_, _, old_hash, new_hash, new_file_size, new_size, _ = struct.unpack_from(DELTA_HEADER, delta_data)
+	if old_hash != hashlib.blake2b(old_file, digest_size=20).digest():
+		print("Delta was made from a different file")
+		return False
+	
+	# Write output data, streaming each slot from the old file or the delta
+	# The output is written to a temporary file and renamed once it matches the file the delta was made from,
+	# so a bad delta leaves nothing behind
+	# The temporary file is opened normally rather than with tempfile, so it gets the usual permissions
+	print(f"Saving new file to {sec_out}")
+	make_dirs_for_file(sec_out)
+	temp_path = f"{sec_out}.{os.getpid()}.tmp"
+	out = open(temp_path, "x+b")
+	try:
+		with out:
+			slot_count = _write_delta(out, old_file, section_old, delta_data)
+			if slot_count == None:
+				return False
+			if out.tell()-section_old.base != new_size or out.tell() > new_file_size:
+				print("Delta produced the wrong section size")
+				return False
+			write_fill(out, ROM_PAD_VALUE, new_file_size-out.tell())
+			out.seek(0)
+			if hashlib.blake2b(out.read(), digest_size=20).digest() != new_hash:
+				print("Delta produced a different file than it was made from")
+				return False
+		os.replace(temp_path, sec_out)
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+	print(f"Applied {slot_count} resources")
+	return True
@@ -1,54 +1,61 @@
 import struct
+import numpy as np
 from PIL import Image
 from util import check_files, make_dirs_for_file
 from util import load_palette, palette_to_rgba, print_palette_rgba
 from util import load_image_as_grayscale, load_image_as_indexed
-from lzss_ww import compress, decompress
+from lzss_ww import decompress, LEVEL_NAMES
+from lzss_cache import compress_cached
 
 def _load_tiles(data):
+	# returns a (num_tiles, 8, 8) array of 4bpp pixel values
 	header_fmt = ">H"
 	header_size = struct.calcsize(header_fmt)
 	if len(data) < header_size:
 		print("Data too short")
 		return None
 	num_tiles = struct.unpack(header_fmt, data[:header_size])[0]
-	data = data[header_size:]
 	if num_tiles == 0:
 		print("No tiles")
 		return None
 	expect_size = num_tiles*32
 	# Resources may be padded
-	if len(data) not in range(expect_size, expect_size+4):
+	if len(data)-header_size not in range(expect_size, expect_size+4):
 		print("Data size mismatch")
 		return None
-	tiles = [None]*num_tiles
-	for t in range(num_tiles):
-		tiles[t] = [0]*64
-		for p in range(64):
-			pv = data[t*32 + p//2]
-			if p&1 == 0:
-				pv >>= 4
-			pv &= 15
-			tiles[t][p] = pv
-	return tiles
+	# Each byte holds two pixels, high nibble first
+	packed = np.frombuffer(data, dtype=np.uint8, count=expect_size, offset=header_size)
+	tiles = np.empty((expect_size, 2), dtype=np.uint8)
+	tiles[:,0] = packed >> 4
+	tiles[:,1] = packed & 15
+	return tiles.reshape(num_tiles, 8, 8)
 
 def _store_tiles(tiles):
+	# tiles is a (num_tiles, 8, 8) array of 4bpp pixel values
 	num_tiles = len(tiles)
 	if num_tiles == 0:
 		print("No tiles")
 		return None
 	header_fmt = ">H"
-	header_size = struct.calcsize(header_fmt)
-	data = bytearray(num_tiles*32)
-	for t in range(num_tiles):
-		for p in range(64):
-			pv = tiles[t][p] & 15
-			if p&1 == 0:
-				pv <<= 4
-			data[t*32 + p//2] |= pv
-	data = struct.pack(header_fmt, num_tiles) + bytes(data)
+	pairs = (np.asarray(tiles, dtype=np.uint8) & 15).reshape(num_tiles*32, 2)
+	packed = (pairs[:,0] << 4) | pairs[:,1]
+	data = struct.pack(header_fmt, num_tiles) + packed.tobytes()
 	return data
 
+def _tiles_to_sheet(tiles, num_columns):
+	# Arrange (num_tiles, 8, 8, ...) tiles in rows of num_columns, filling the last row with zeros
+	num_tiles = len(tiles)
+	num_rows = (num_tiles+num_columns-1) // num_columns
+	cells = np.zeros((num_rows*num_columns,) + tiles.shape[1:], dtype=tiles.dtype)
+	cells[:num_tiles] = tiles
+	cells = cells.reshape((num_rows, num_columns) + tiles.shape[1:])
+	return cells.swapaxes(1, 2).reshape((num_rows*8, num_columns*8) + tiles.shape[3:])
+
+def _sheet_to_tiles(sheet, num_columns, num_rows):
+	# Cut a sheet into (num_rows*num_columns, 8, 8) tiles, row by row
+	cells = sheet[:num_rows*8, :num_columns*8].reshape(num_rows, 8, num_columns, 8)
+	return cells.swapaxes(1, 2).reshape(num_rows*num_columns, 8, 8)
+
 def _load_map(data):
 	header_fmt = ">BB"
 	header_size = struct.calcsize(header_fmt)
@@ -63,19 +70,45 @@ def _load_map(data):
 	if len(data) not in range(expect_size, expect_size+4):
 		print("Data size mismatch")
 		return None
-	tdata = struct.unpack(f">{map_width*map_height}H", data)
-	tilemap = [[None]*map_height for i in range(map_width)]
-	for y in range(map_height):
-		for x in range(map_width):
-			t = tdata[y*map_width+x]
-			tile_idx = t & 0x7FF
-			tile_scrn = (t>>11) & 1
-			tile_subpal = (t>>12) & 3
-			tile_flipx = ((t>>14) & 1) == 1
-			tile_flipy = ((t>>15) & 1) == 1
-			tilemap[x][y] = (tile_idx, tile_flipx, tile_flipy, tile_subpal, tile_scrn)
+	# Split every tile word into (map_height, map_width) arrays of its fields
+	tdata = np.frombuffer(data, dtype=">u2", count=map_width*map_height).reshape(map_height, map_width)
+	tile_idx = tdata & 0x7FF
+	tile_scrn = (tdata>>11) & 1
+	tile_subpal = (tdata>>12) & 3
+	tile_flipx = ((tdata>>14) & 1) == 1
+	tile_flipy = ((tdata>>15) & 1) == 1
+	tilemap = (tile_idx, tile_flipx, tile_flipy, tile_subpal, tile_scrn)
 	return (tilemap, map_width, map_height)
 
+def _render_tilemap(tilemap, tiles, subpalettes_rgba, scrnb):
+	# Render the tiles on one screen of a tilemap to a (height, width, 4) RGBA array
+	# Tiles on the other screen are left transparent
+	tile_idx, tile_flipx, tile_flipy, tile_subpal, tile_scrn = tilemap
+	map_height, map_width = tile_idx.shape
+	shown = (tile_scrn == 1) == scrnb
+	
+	# Report the first invalid tile in the same column-major order as the map is listed
+	bad_idx = shown & (tile_idx >= len(tiles))
+	bad_subpal = shown & (tile_subpal >= len(subpalettes_rgba))
+	bad = np.argwhere((bad_idx | bad_subpal).T)
+	if len(bad) > 0:
+		x, y = bad[0]
+		if bad_idx[y,x]:
+			print(f"Invalid tile index {tile_idx[y,x]} at tile {x},{y}")
+		else:
+			print(f"Invalid subpalette {tile_subpal[y,x]} at tile {x},{y}")
+		return None
+	
+	# Gather tile pixels, flip them in place, then map through the subpalettes
+	pixels = tiles[np.where(shown, tile_idx, 0)]
+	pixels[tile_flipx] = pixels[tile_flipx][:,:,::-1]
+	pixels[tile_flipy] = pixels[tile_flipy][:,::-1,:]
+	palette_lut = np.zeros((max(1, len(subpalettes_rgba)), 16, 4), dtype=np.uint8)
+	palette_lut[:len(subpalettes_rgba)] = subpalettes_rgba
+	rgba = palette_lut[np.where(shown, tile_subpal, 0)[:,:,None,None], pixels]
+	rgba[~shown] = 0
+	return rgba.swapaxes(1, 2).reshape(map_height*8, map_width*8, 4)
+
 def cmd_decode_tilesheet(args):
 	# Parse and verify command arguments
 	res_tiles_in = args.path_res_tiles_in
@@ -136,7 +169,7 @@ def cmd_decode_tilesheet(args):
 	
 	# Load and verify tiles
 	tiles = _load_tiles(data_tiles)
-	if tiles == None:
+	if tiles is None:
 		print(f"Try {comp_uncomp_other}.")
 		return False
 	num_tiles = len(tiles)
@@ -149,7 +182,7 @@ def cmd_decode_tilesheet(args):
 
 	# Write output image
 	if indexed:
-		img = Image.new("P", img_size, color=0)
+		img = Image.frombytes("P", img_size, _tiles_to_sheet(tiles, 8).tobytes())
 		if transp:
 			img.info["transparency"] = 0
 		palette_rgb_flat = [0]*16*3
@@ -157,18 +190,8 @@ def cmd_decode_tilesheet(args):
 			palette_rgb_flat[i*3:i*3+3] = palette_rgba[i][:3]
 		img.putpalette(palette_rgb_flat)
 	else:
-		img = Image.new("RGBA", img_size, color=(0,0,0,0))
-	pix = img.load()
-	for t in range(num_tiles):
-		for tx in range(8):
-			for ty in range(8):
-				color_value = tiles[t][ty*8 + tx]
-				ix = (t&7)*8 + tx
-				iy = (t//8)*8 + ty
-				if indexed:
-					pix[ix,iy] = color_value
-				else:
-					pix[ix,iy] = palette_rgba[color_value]
+		palette_lut = np.array(palette_rgba, dtype=np.uint8)
+		img = Image.fromarray(_tiles_to_sheet(palette_lut[tiles], 8))
 	print(f"Saving to {im_out}")
 	make_dirs_for_file(im_out)
 	img.save(im_out)
@@ -181,13 +204,18 @@ def cmd_encode_tilesheet(args):
 	comp = args.compressed
 	indexed = args.indexed
 	num_tiles = args.num_tiles
+	level = args.level
+	cache = args.cache
 	trim_end = False
 	if num_tiles < 1:
 		num_tiles = None
 		trim_end = True
 	if not check_files(exist=[im_in], noexist=[res_tiles_out]):
 		return False
-	print("Compressed: " + ("YES" if comp else "NO"))
+	if level < 0 or level >= len(LEVEL_NAMES):
+		print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+		return False
+	print("Compressed: " + (f"YES ({LEVEL_NAMES[level]})" if comp else "NO"))
 	print("Indexed-color: " + ("YES" if indexed else "NO"))
 	print("Number of tiles: " + str(num_tiles or "(from image)"))
 	
@@ -208,25 +236,14 @@ def cmd_encode_tilesheet(args):
 		img = load_image_as_grayscale(img, 16)
 	if img == None:
 		return False
-	pix = img.load()
 	
 	# Get tiles from input image
-	tiles = [None]*num_tiles
-	last_nonempty = -1
-	for t in range(num_tiles):
-		tiledata = [0]*64
-		empty = True
-		for tx in range(8):
-			for ty in range(8):
-				ix = (t%num_columns)*8 + tx
-				iy = (t//num_columns)*8 + ty
-				value =  pix[ix,iy]
-				if value > 0:
-					empty = False
-				tiledata[ty*8 + tx] = value
-		tiles[t] = tiledata
-		if not empty:
-			last_nonempty = t
+	if num_tiles > num_columns*num_rows:
+		print(f"Image only contains {num_columns*num_rows} tiles")
+		return False
+	tiles = _sheet_to_tiles(np.asarray(img, dtype=np.uint8), num_columns, num_rows)[:num_tiles]
+	nonempty = np.flatnonzero(tiles.reshape(num_tiles, 64).any(axis=1))
+	last_nonempty = int(nonempty[-1]) if len(nonempty) > 0 else -1
 	if trim_end and last_nonempty+1 != num_tiles:
 		diff = num_tiles - (last_nonempty+1)
 		num_tiles = last_nonempty+1
@@ -243,7 +260,7 @@ def cmd_encode_tilesheet(args):
 	
 	# Compress tilesheet data if necessary
 	if comp:
-		data_tiles = compress(data_tiles)
+		data_tiles = compress_cached(data_tiles, level, cache)
 		if data_tiles == None:
 			return False
 		print(f"Compressed {len(data_tiles)} bytes")
@@ -313,7 +330,7 @@ def cmd_decode_tilemap(args):
 	
 	# Load and verify tiles
 	tiles = _load_tiles(data_tiles)
-	if tiles == None:
+	if tiles is None:
 		print(f"Try {comp_uncomp_other}.")
 		return False
 	num_tiles = len(tiles)
@@ -325,26 +342,10 @@ def cmd_decode_tilemap(args):
 	print(f"Tilemap contains {map_width}x{map_height} tiles, output in {img_width}x{img_height} image")
 
 	# Write output image
-	img = Image.new("RGBA", (img_width, img_height), color = (0,0,0,0))
-	pix = img.load()
-	for x in range(map_width):
-		for y in range(map_height):
-			tile_idx, tile_flipx, tile_flipy, tile_subpal, tile_scrn = tilemap[x][y]
-			#tile_flipx = True
-			if (tile_scrn==1) != scrnb:
-				continue
-			if tile_idx >= num_tiles:
-				print(f"Invalid tile index {tile_idx} at tile {x},{y}")
-				return False
-			if tile_subpal >= num_subpals:
-				print(f"Invalid subpalette {tile_subpal} at tile {x},{y}")
-				return False
-			for tx in range(tilesize):
-				for ty in range(tilesize):
-					color_value = tiles[tile_idx][ty*8 + tx]
-					ix = x*tilesize + ((tilesize-1-tx) if tile_flipx else tx) 
-					iy = y*tilesize + ((tilesize-1-ty) if tile_flipy else ty) 
-					pix[ix,iy] = subpalettes_rgba[tile_subpal][color_value]
+	rgba = _render_tilemap(tilemap, tiles, subpalettes_rgba, scrnb)
+	if rgba is None:
+		return False
+	img = Image.fromarray(rgba)
 	print(f"Saving to {im_out}")
 	make_dirs_for_file(im_out)
 	img.save(im_out)
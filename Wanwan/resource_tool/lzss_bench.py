@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+from util import parsenum
+from lzss_ww import compress, decompress, LEVEL_NAMES, ENCODER_VERSION
+from resource_section import ResourceSection, find_compressed_stream
+
+# Benchmark and regression suite for lzss_ww
+# Builds a synthetic corpus shaped like Wanwan resources, measures throughput, ratio and peak memory,
+# optionally recompresses the streams in a real resource section, and compares against a saved baseline
+
+def _make_tilesheet(rng, num_tiles=512):
+	# 4bpp tiles drawn from a few shapes and colors, with blank and repeated tiles like real sheets
+	tiles = []
+	for t in range(num_tiles):
+		kind = rng.random()
+		if kind < 0.2:
+			tile = bytes(32)
+		elif kind < 0.35 and tiles:
+			tile = rng.choice(tiles)
+		else:
+			fg = rng.randrange(1, 16)
+			bg = rng.choice([0, 0, rng.randrange(16)])
+			cx = rng.randrange(8)
+			cy = rng.randrange(8)
+			r2 = rng.randrange(4, 40)
+			pixels = [fg if (x-cx)**2+(y-cy)**2 < r2 else bg for y in range(8) for x in range(8)]
+			tile = bytes(pixels[p]<<4 | pixels[p+1] for p in range(0, 64, 2))
+		tiles.append(tile)
+	return struct.pack(">H", num_tiles) + b"".join(tiles)
+
+def _make_bitmap(rng, width=256, height=224):
+	# 8bpp picture with smooth gradients, flat areas and some noise
+	rows = []
+	base = rng.randrange(256)
+	for y in range(height):
+		row = bytearray(width)
+		for x in range(width):
+			v = (base + x//16 + y//12) & 255
+			if (x//32 + y//32) % 3 == 0:
+				v = 17
+			elif rng.random() < 0.05:
+				v = rng.randrange(256)
+			row[x] = v
+		rows.append(bytes(row))
+	return struct.pack("BB", width&255, height&255) + b"".join(rows)
+
+def _make_tilemap(rng, width=32, height=28):
+	# u16 tile words with mostly sequential indices and a few flips and subpalettes
+	words = []
+	next_tile = 0
+	for i in range(width*height):
+		if rng.random() < 0.3:
+			words.append(0)
+			continue
+		attr = (rng.randrange(4)<<12) if rng.random() < 0.1 else 0
+		attr |= (1<<14) if rng.random() < 0.05 else 0
+		words.append((next_tile & 0x7FF) | attr)
+		next_tile += 1
+	return struct.pack(f">BB{width*height}H", width, height, *words)
+
+def _make_palette(rng, num_colors=256):
+	# RGB555 colors in smooth ramps
+	colors = []
+	for i in range(num_colors):
+		ramp = i//16
+		step = i%16
+		r = (ramp*5 + step) & 31
+		g = (ramp*3 + step*2) & 31
+		b = (ramp*7 + rng.randrange(2)) & 31
+		colors.append(r<<10 | g<<5 | b)
+	return struct.pack(f">H{num_colors}H", num_colors, *colors)
+
+def _make_text(rng, num_lines=400):
+	# Script-like lines with control codes, repeated names and phrases
+	names = [b"Wanwan", b"Pochi", b"Kuro", b"Hana"]
+	phrases = [b"Let's go for a walk!", b"I'm so hungry...", b"Look over there.", b"Thank you!", b"Where is the ball?"]
+	lines = []
+	for i in range(num_lines):
+		lines.append(b"\x01" + rng.choice(names) + b": " + rng.choice(phrases) + b"\x00")
+	return b"".join(lines)
+
+def make_corpus(seed=1234):
+	# returns a list of (name, data) synthetic resources
+	rng = random.Random(seed)
+	return [
+		("tilesheet", _make_tilesheet(rng)),
+		("bitmap", _make_bitmap(rng)),
+		("tilemap", _make_tilemap(rng)),
+		("palette", _make_palette(rng)),
+		("text", _make_text(rng)),
+	]
+
+def _section_streams(sec_data):
+	# Find every compressed stream in a resource section, the same way recompress-section does
+	# returns a list of streams, or None after printing the problem
+	section = ResourceSection.parse(sec_data)
+	if section == None:
+		return None
+	# Resources sharing a slot are only counted once
+	slot_indices = {}
+	for res_index in range(len(section)):
+		if not section.is_null(res_index):
+			slot_indices.setdefault(section.offset(res_index), res_index)
+	streams = []
+	for res_offset, res_index in sorted(slot_indices.items()):
+		comp_sizes = find_compressed_stream(section[res_index])
+		if comp_sizes == None:
+			continue
+		streams.append(bytes(section[res_index][:comp_sizes[0]]))
+	return streams
+
+def _measure(data, level, repeats):
+	# Best of several runs for speed, and one traced run for peak memory
+	best_compress = None
+	best_decompress = None
+	for i in range(repeats):
+		ts = time.perf_counter()
+		comp_data = compress(data, level)
+		t = time.perf_counter()-ts
+		best_compress = t if best_compress == None else min(best_compress, t)
+		ts = time.perf_counter()
+		decomp_data = decompress(comp_data)
+		t = time.perf_counter()-ts
+		best_decompress = t if best_decompress == None else min(best_decompress, t)
+		if decomp_data != data:
+			raise ValueError("Round-trip mismatch")
+	tracemalloc.start()
+	compress(data, level)
+	peak_memory = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return {
+		"size": len(data),
+		"compressed_size": len(comp_data),
+		"ratio": len(comp_data)/max(1, len(data)),
+		"compress_mbps": len(data)/max(best_compress, 1e-9)/1e6,
+		"decompress_mbps": len(data)/max(best_decompress, 1e-9)/1e6,
+		"peak_memory": peak_memory,
+	}
+
+def run_benchmark(levels, repeats, sec_path=None):
+	results = {}
+	for name, data in make_corpus():
+		for level in levels:
+			key = f"{name}/{LEVEL_NAMES[level]}"
+			print(f"Benchmarking {key} ({len(data)} bytes)")
+			results[key] = _measure(data, level, repeats)
+
+	# Recompress the original streams and compare sizes
+	if sec_path:
+		with open(sec_path, "rb") as f:
+			sec_data = f.read()
+		streams = _section_streams(sec_data)
+		if streams == None:
+			return None
+		print(f"Found {len(streams)} compressed streams in {sec_path}")
+		decomp_streams = [bytes(decompress(s)) for s in streams]
+		original_size = sum(len(s) for s in streams)
+		for level in levels:
+			key = f"section/{LEVEL_NAMES[level]}"
+			print(f"Benchmarking {key} ({sum(len(d) for d in decomp_streams)} bytes)")
+			ts = time.perf_counter()
+			new_size = sum(len(compress(d, level)) for d in decomp_streams)
+			t = time.perf_counter()-ts
+			results[key] = {
+				"size": sum(len(d) for d in decomp_streams),
+				"compressed_size": new_size,
+				"original_compressed_size": original_size,
+				"ratio": new_size/max(1, original_size),
+				"compress_mbps": sum(len(d) for d in decomp_streams)/max(t, 1e-9)/1e6,
+			}
+	return results
+
+def check_regressions(results, baseline, speed_tolerance, ratio_tolerance):
+	# returns a list of messages for every result that got slower or compressed worse than the baseline
+	failures = []
+	for key, result in results.items():
+		base = baseline.get(key)
+		if not base:
+			continue
+		for metric in ["compress_mbps", "decompress_mbps"]:
+			if metric in result and metric in base and result[metric] < base[metric]*(1-speed_tolerance):
+				failures.append(f"{key} {metric} {result[metric]:.3f} < baseline {base[metric]:.3f}")
+		if result["ratio"] > base["ratio"]*(1+ratio_tolerance):
+			failures.append(f"{key} ratio {result['ratio']:.4f} > baseline {base['ratio']:.4f}")
+	return failures
+
+def print_results(results):
+	print()
+	print("Result".ljust(24) + "Size".rjust(10) + "Ratio".rjust(8) + "Comp MB/s".rjust(11) + "Decomp MB/s".rjust(13) + "Peak KiB".rjust(10))
+	for key, r in results.items():
+		decomp_speed = f"{r['decompress_mbps']:.3f}" if "decompress_mbps" in r else "-"
+		peak_memory = f"{r['peak_memory']//1024}" if "peak_memory" in r else "-"
+		print(key.ljust(24) + str(r["size"]).rjust(10) + f"{r['ratio']:.3f}".rjust(8) + f"{r['compress_mbps']:.3f}".rjust(11) + decomp_speed.rjust(13) + peak_memory.rjust(10))
+
+def main(args):
+	progname = os.path.basename(args.pop(0))
+	parser = argparse.ArgumentParser(prog=progname, description="Benchmark lzss_ww and check for regressions")
+	parser.add_argument("-s", "--section", metavar="resources.bin", help="Also recompress the streams in a resource section", dest="section", default=None)
+	parser.add_argument("-o", "--output", metavar="results.json", help="Save results as JSON", dest="output", default=None)
+	parser.add_argument("-b", "--baseline", metavar="baseline.json", help="Fail if results regress from these saved results", dest="baseline", default=None)
+	parser.add_argument("-l", "--levels", metavar="levels", help="Comma-separated compression levels (default all)", dest="levels", default=None)
+	parser.add_argument("-r", "--repeats", metavar="repeats", help="Timed runs per result, best is kept (default 3)", dest="repeats", type=parsenum, default=3)
+	parser.add_argument("-t", "--speed_tolerance", metavar="fraction", help="Allowed throughput drop (default 0.25)", dest="speed_tolerance", type=float, default=0.25)
+	parser.add_argument("-T", "--ratio_tolerance", metavar="fraction", help="Allowed ratio increase (default 0.005)", dest="ratio_tolerance", type=float, default=0.005)
+	parsed_args = parser.parse_args(args)
+
+	if parsed_args.levels:
+		levels = [parsenum(x) for x in parsed_args.levels.split(",")]
+	else:
+		levels = list(range(len(LEVEL_NAMES)))
+	for level in levels:
+		if level < 0 or level >= len(LEVEL_NAMES):
+			print(f"Compression level out of range (0-{len(LEVEL_NAMES)-1})")
+			return False
+
+	results = run_benchmark(levels, max(1, parsed_args.repeats), parsed_args.section)
+	if results == None:
+		return False
+	print_results(results)
+
+	if parsed_args.output:
+		print(f"Saving results to {parsed_args.output}")
+		with open(parsed_args.output, "w") as f:
+			json.dump({"encoder_version": ENCODER_VERSION, "results": results}, f, indent="\t")
+
+	if parsed_args.baseline:
+		with open(parsed_args.baseline, "r") as f:
+			baseline = json.load(f)["results"]
+		failures = check_regressions(results, baseline, parsed_args.speed_tolerance, parsed_args.ratio_tolerance)
+		if failures:
+			print("Regressions found:")
+			for msg in failures:
+				print(msg)
+			return False
+		print("No regressions against baseline")
+	return True
+
+if __name__ == "__main__":
+	if not main(sys.argv):
+		exit(1)
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+from lzss_ww import compress, compress_many, ENCODER_VERSION
+
+# Content-addressed cache of compressed resources, shared between builds
+# Entries are keyed by a hash of the uncompressed data, compression level and encoder version,
+# written atomically, and evicted least-recently-used first once the cache grows too large
+# The cache directory is only scanned for eviction once per batch, and only when a running estimate of its size,
+# taken from the last scan plus everything written since, goes past the limit
+
+CACHE_DEFAULT_MAX_SIZE = 256*1024*1024
+CACHE_SUFFIX = ".lzss"
+
+# Size of each cache directory as of the last scan, plus entries written since
+_size_estimates = {}
+
+class CompressionCache:
+	def __init__(self, cache_dir, max_size=CACHE_DEFAULT_MAX_SIZE):
+		self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+		self.max_size = max_size
+		self.written = 0
+		os.makedirs(self.cache_dir, exist_ok=True)
+	
+	def _path(self, data, level):
+		h = hashlib.blake2b(digest_size=20)
+		h.update(f"lzss_ww/{ENCODER_VERSION}/{level}/".encode("ascii"))
+		h.update(data)
+		return os.path.join(self.cache_dir, h.hexdigest()+CACHE_SUFFIX)
+	
+	def get(self, data, level):
+		# returns cached compressed bytes, or None if not cached
+		path = self._path(data, level)
+		try:
+			with open(path, "rb") as f:
+				comp_data = f.read()
+			# Mark as recently used
+			os.utime(path)
+		except OSError:
+			return None
+		return comp_data
+	
+	def put(self, data, level, comp_data):
+		# Write to a temporary file and rename, so readers never see a partial entry
+		path = self._path(data, level)
+		fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(comp_data)
+			os.replace(temp_path, path)
+		except OSError:
+			try:
+				os.remove(temp_path)
+			except OSError:
+				pass
+			return
+		self.written += 1
+		if self.cache_dir in _size_estimates:
+			_size_estimates[self.cache_dir] += len(comp_data)
+	
+	def compress(self, data, level):
+		# returns compressed bytes from the cache, compressing and caching them if needed
+		data = bytes(data)
+		comp_data = self.get(data, level)
+		if comp_data == None:
+			comp_data = bytes(compress(data, level))
+			self.put(data, level, comp_data)
+		return comp_data
+	
+	def evict(self):
+		# Remove least recently used entries until under max_size, call once after a batch of puts
+		# The directory is only scanned if anything was written and its size is unknown or estimated to be over max_size
+		if self.written == 0:
+			return
+		size_estimate = _size_estimates.get(self.cache_dir)
+		if size_estimate != None and size_estimate <= self.max_size:
+			return
+		_size_estimates[self.cache_dir] = self._evict()
+	
+	def _evict(self):
+		# Remove least recently used entries until under max_size
+		# Other builds may be evicting at the same time, so missing files are fine
+		# returns the remaining size of the cache
+		entries = []
+		total_size = 0
+		with os.scandir(self.cache_dir) as it:
+			for entry in it:
+				if not entry.name.endswith(CACHE_SUFFIX):
+					continue
+				try:
+					st = entry.stat()
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, entry.path))
+				total_size += st.st_size
+		if total_size <= self.max_size:
+			return total_size
+		entries.sort()
+		for mtime, size, path in entries:
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			total_size -= size
+			if total_size <= self.max_size:
+				break
+		return total_size
+
+def compress_cached(data, level, cache_dir=None):
+	# Compress through the cache in cache_dir, or directly if there is none
+	if not cache_dir:
+		return compress(data, level)
+	cache = CompressionCache(cache_dir)
+	comp_data = cache.compress(data, level)
+	cache.evict()
+	return comp_data
+
+def compress_many_cached(inputs, level, cache_dir=None, workers=None):
+	# Compress a batch in parallel, only sending inputs missing from the cache to the workers
+	inputs = [bytes(x) for x in inputs]
+	if not cache_dir:
+		return compress_many(inputs, workers, level)
+	cache = CompressionCache(cache_dir)
+	outputs = [cache.get(x, level) for x in inputs]
+	missing = [i for i in range(len(inputs)) if outputs[i] == None]
+	for i, comp_data in zip(missing, compress_many([inputs[i] for i in missing], workers, level)):
+		outputs[i] = bytes(comp_data)
+		cache.put(inputs[i], level, outputs[i])
+	cache.evict()
+	return outputs
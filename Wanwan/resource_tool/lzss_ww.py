@@ -1,166 +1,925 @@
-import io
-import struct
+import array
+import bisect
+import concurrent.futures
+import functools
+import itertools
+import os
+import numpy as np
 
 # Compressor & decompressor implementation by Kasami (2024)
 # For modified LZSS used in "Wanwan Aijou Monogatari" by Alfa System (1995)
 
-def compress(input_data):
-	# input_data is bytes or bytearray input
-	# returns compressed bytes
+# Format limits
+WINDOW_SIZE = 4096
+SHORT_WINDOW_SIZE = 64
+MAX_COPY_LENGTH = 257
+MAX_SHORT_COPY_LENGTH = 5
+MAX_LONG_COPY_LENGTH = 17
+
+# Token sizes in bits, including flag bits
+BITS_LITERAL = 9
+BITS_SHORT_COPY = 10
+BITS_LONG_COPY = 18
+BITS_EXTENDED_COPY = 26
+
+# Token kinds
+TOKEN_LITERAL = 0
+TOKEN_SHORT_COPY = 1
+TOKEN_LONG_COPY = 2
+TOKEN_EXTENDED_COPY = 3
+TOKEN_NAMES = ["literal", "short", "long", "extended"]
+TOKEN_BITS = [BITS_LITERAL, BITS_SHORT_COPY, BITS_LONG_COPY, BITS_EXTENDED_COPY]
+
+# Compression levels
+LEVEL_GREEDY = 0
+LEVEL_LAZY = 1
+LEVEL_OPTIMAL = 2
+LEVEL_NAMES = ["greedy", "lazy", "optimal"]
+
+# Bump whenever compressed output changes for the same input and level
+ENCODER_VERSION = 1
+
+# Chain candidates to check before falling back to a full window search
+MAX_CHAIN_WALK = 32
+# Smaller inputs are searched with rfind alone, as building chains costs more than it saves
+CHAIN_MIN_INPUT = 2048
+
+# Input held back by LzssCompressor so matches can reach their full length,
+# and the amount of new input parsed at a time
+STREAM_LOOKAHEAD = MAX_COPY_LENGTH+1
+STREAM_BLOCK_SIZE = 16384
+
+class _MatchFinder:
+	# Finds matches in input_data using hash chains, which link every position
+	# to the previous one with the same 3-byte prefix
+	# The chains are built for the whole input at once by sorting positions on their prefix,
+	# starting from the window before the first position that will be searched
 	
-	input_size = len(input_data)
-	output_data = bytearray()
+	def __init__(self, input_data, start=0):
+		self.input_data = input_data
+		self.input_size = len(input_data)
+		self.chain_prev = None
+		chain_start = max(0, start-WINDOW_SIZE)
+		if self.input_size-chain_start < CHAIN_MIN_INPUT:
+			return
+		# A stable sort keeps positions with the same prefix in order, so each links to the one before it
+		data = np.frombuffer(input_data, dtype=np.uint8)[chain_start:].astype(np.int32)
+		keys = data[:-2]<<16 | data[1:-1]<<8 | data[2:]
+		order = np.argsort(keys, kind="stable")
+		same = keys[order[1:]] == keys[order[:-1]]
+		chain_prev = np.full(len(keys), -1, dtype=np.int64)
+		chain_prev[order[1:][same]] = order[:-1][same]+chain_start
+		self.chain_prev = [-1]*chain_start + chain_prev.tolist()
 	
-	# Set up convenience for writing flag bits
-	flags_pointer = 0
-	flags_counter = 0
-	def _write_flag_bit(b):
-		nonlocal output_data, flags_pointer, flags_counter
-		if flags_counter&7 == 0:
-			flags_counter = 0
-			flags_pointer = len(output_data)
-			output_data.append(0)
-		if b:
-			output_data[flags_pointer] |= 1 << flags_counter
-		flags_counter += 1
+	def _extend_match(self, try_index, input_ptr, try_len, available_length):
+		# Count how far a match at try_index extends, given it already matches try_len bytes
+		# Compare the rest in one go as big integers, the highest differing byte ends the match
+		input_data = self.input_data
+		if try_len >= available_length or input_data[try_index+try_len] != input_data[input_ptr+try_len]:
+			return try_len
+		a = int.from_bytes(input_data[try_index+try_len:try_index+available_length], "big")
+		b = int.from_bytes(input_data[input_ptr+try_len:input_ptr+available_length], "big")
+		return available_length - (((a^b).bit_length()+7)>>3)
 	
-	input_ptr = 0
-	while input_ptr < input_size:
+	def find_match(self, input_ptr):
+		# Find the longest possible match in valid search window, biased to nearest
+		# being careful not to start any further along than previous character
+		# returns (length, offset), or (0, 0) if there is no encodable match
+		input_data = self.input_data
+		available_length = min(self.input_size-input_ptr, MAX_COPY_LENGTH)
+		if input_ptr == 0 or available_length < 2:
+			return (0, 0)
 		match_len = 0
 		match_offset = 0
-		available_length = min(input_size-input_ptr, 257)
-		available_offset = min(input_ptr, 4096)
+		window_start = max(0, input_ptr-WINDOW_SIZE)
+		try_len = 2
 		
-		# Find the longest possible match in valid search window, biased to nearest (rfind)
-		# being careful not to start any further along than previous character
-		if input_ptr > 0 and available_length >= 2:
-			for try_len in range(2, available_length+1):
-				try_match = input_data[input_ptr:input_ptr+try_len]
-				match_index = input_data.rfind(try_match, input_ptr-available_offset, input_ptr+try_len-1)
-				if match_index == -1:
+		chain_prev = self.chain_prev
+		if chain_prev != None and available_length >= 3:
+			# Walk the chain nearest first, only taking strictly longer matches
+			# Every entry shares the 3-byte prefix, so start as if 2 bytes already matched
+			try_index = chain_prev[input_ptr]
+			chain_budget = MAX_CHAIN_WALK
+			best_len = 2
+			while try_index >= window_start:
+				if chain_budget == 0:
 					break
-				try_offset = input_ptr-match_index
-				
-				# Exclude short&far matches that can't be encoded, but keep searching
-				if try_len > 2 or try_offset <= 64:
-					match_len = try_len
-					match_offset = try_offset
+				chain_budget -= 1
+				# Cheap reject on the byte that would make this match longer
+				if input_data[try_index+best_len] == input_data[input_ptr+best_len] and input_data[try_index:try_index+best_len] == input_data[input_ptr:input_ptr+best_len]:
+					best_len = self._extend_match(try_index, input_ptr, best_len+1, available_length)
+					match_len = best_len
+					match_offset = input_ptr-try_index
+					if match_len == available_length:
+						break
+				try_index = chain_prev[try_index]
+			if chain_budget > 0:
+				if match_len > 0:
+					return (match_len, match_offset)
+				# Short&far matches can't be encoded, so only look for length 2 nearby
+				return self.find_short_match(input_ptr, 2)
+			# Long chains are cut short, so make sure nothing longer is left further back
+			try_len = max(match_len+1, 3)
+		
+		# Find the nearest match of each length with rfind, then extend it as far as it goes,
+		# so every search finds a strictly longer match
+		while try_len <= available_length:
+			match_index = input_data.rfind(input_data[input_ptr:input_ptr+try_len], window_start, input_ptr+try_len-1)
+			if match_index == -1:
+				break
+			match_offset = input_ptr-match_index
+			match_len = try_len
+			if try_len < available_length and input_data[match_index+try_len] == input_data[input_ptr+try_len]:
+				match_len = self._extend_match(match_index, input_ptr, try_len+1, available_length)
+			try_len = match_len+1
 		
-		# Encode the result with Wanwan's encoding
-		if match_len > 0:
-			input_ptr += match_len
-			# Emit copy codes for the match
-			_write_flag_bit(0)
-			if match_offset <= 64 and match_len >= 2 and match_len <= 5:
+		# A match of only 2 is the nearest one, so if it is too far for a short copy there is none
+		if match_len == 2 and match_offset > SHORT_WINDOW_SIZE:
+			return (0, 0)
+		return (match_len, match_offset)
+	
+	def find_short_match(self, input_ptr, max_len=MAX_SHORT_COPY_LENGTH):
+		# Find the longest match up to max_len that fits a short copy, biased to nearest
+		# returns (length, offset), or (0, 0) if there is none
+		input_data = self.input_data
+		window_start = max(0, input_ptr-SHORT_WINDOW_SIZE)
+		try_len = min(self.input_size-input_ptr, max_len)
+		while try_len >= 2:
+			match_index = input_data.rfind(input_data[input_ptr:input_ptr+try_len], window_start, input_ptr+try_len-1)
+			if match_index != -1:
+				return (try_len, input_ptr-match_index)
+			try_len -= 1
+		return (0, 0)
+
+# Parsers take input_data with any history before start, and return tokens
+# covering at least start to end as a list of (length, offset) copies, where length 0 is a literal
+
+def _parse_greedy(input_data, start=0, end=None):
+	# Take the longest match at every position
+	if end == None:
+		end = len(input_data)
+	find_match = _MatchFinder(input_data, start).find_match
+	tokens = []
+	input_ptr = start
+	while input_ptr < end:
+		match = find_match(input_ptr)
+		tokens.append(match)
+		input_ptr += match[0] or 1
+	return tokens
+
+def _copy_kind(match_len, match_offset):
+	# Pick the smallest encoding for a copy
+	if match_offset <= SHORT_WINDOW_SIZE and match_len <= MAX_SHORT_COPY_LENGTH:
+		return TOKEN_SHORT_COPY
+	if match_len <= MAX_LONG_COPY_LENGTH:
+		return TOKEN_LONG_COPY
+	return TOKEN_EXTENDED_COPY
+
+def _token_bits(match_len, match_offset):
+	# Size of a token in bits, matching the choice made by _copy_kind
+	if match_len == 0:
+		return BITS_LITERAL
+	return TOKEN_BITS[_copy_kind(match_len, match_offset)]
+
+def _parse_lazy(input_data, start=0, end=None):
+	# Like greedy, but emit a literal instead if that plus the match at the next position
+	# costs fewer bits per byte covered
+	input_size = len(input_data)
+	if end == None:
+		end = input_size
+	finder = _MatchFinder(input_data, start)
+	tokens = []
+	input_ptr = start
+	match = finder.find_match(input_ptr)
+	while input_ptr < end:
+		match_len = match[0]
+		if match_len > 0 and match_len < MAX_COPY_LENGTH and input_ptr+1 < input_size:
+			next_match = finder.find_match(input_ptr+1)
+			if (BITS_LITERAL+_token_bits(*next_match))*match_len < _token_bits(*match)*(1+next_match[0]):
+				tokens.append((0, 0))
+				input_ptr += 1
+				match = next_match
+				continue
+		tokens.append(match)
+		input_ptr += match_len or 1
+		match = finder.find_match(input_ptr)
+	return tokens
+
+def _parse_optimal(input_data, start=0, end=None):
+	# Find the parse with the fewest bits by dynamic programming from the end
+	# Copies are cut short at end, so the parse is only optimal within start to end
+	if end == None:
+		end = len(input_data)
+	finder = _MatchFinder(input_data, start)
+	
+	# Collect the longest match and longest short copy at every position
+	# Any shorter copy can reuse the same offset
+	long_matches = [None]*end
+	short_matches = [None]*end
+	for input_ptr in range(start, end):
+		match_len, match_offset = finder.find_match(input_ptr)
+		match_len = min(match_len, end-input_ptr)
+		long_matches[input_ptr] = (match_len, match_offset)
+		if match_offset <= SHORT_WINDOW_SIZE:
+			short_matches[input_ptr] = (min(match_len, MAX_SHORT_COPY_LENGTH), match_offset)
+		else:
+			short_matches[input_ptr] = finder.find_short_match(input_ptr, min(end-input_ptr, MAX_SHORT_COPY_LENGTH))
+	
+	# Price every suffix, remembering the best token to start it with
+	# Copy sizes only depend on length range, so take the cheapest suffix in each range
+	costs = [0]*(end+1)
+	choices = [None]*end
+	for input_ptr in range(end-1, start-1, -1):
+		best_cost = BITS_LITERAL + costs[input_ptr+1]
+		best_choice = (0, 0)
+		short_len, short_offset = short_matches[input_ptr]
+		if short_len >= 2:
+			range_end = input_ptr+short_len+1
+			suffix_cost = min(costs[input_ptr+2:range_end])
+			if BITS_SHORT_COPY + suffix_cost < best_cost:
+				best_cost = BITS_SHORT_COPY + suffix_cost
+				best_choice = (costs.index(suffix_cost, input_ptr+2, range_end)-input_ptr, short_offset)
+		match_len, match_offset = long_matches[input_ptr]
+		if match_len >= 3:
+			range_end = input_ptr+min(match_len, MAX_LONG_COPY_LENGTH)+1
+			suffix_cost = min(costs[input_ptr+3:range_end])
+			if BITS_LONG_COPY + suffix_cost < best_cost:
+				best_cost = BITS_LONG_COPY + suffix_cost
+				best_choice = (costs.index(suffix_cost, input_ptr+3, range_end)-input_ptr, match_offset)
+		if match_len > MAX_LONG_COPY_LENGTH:
+			range_end = input_ptr+match_len+1
+			suffix_cost = min(costs[input_ptr+MAX_LONG_COPY_LENGTH+1:range_end])
+			if BITS_EXTENDED_COPY + suffix_cost < best_cost:
+				best_cost = BITS_EXTENDED_COPY + suffix_cost
+				best_choice = (costs.index(suffix_cost, input_ptr+MAX_LONG_COPY_LENGTH+1, range_end)-input_ptr, match_offset)
+		costs[input_ptr] = best_cost
+		choices[input_ptr] = best_choice
+	
+	# Follow the choices from the start
+	tokens = []
+	input_ptr = start
+	while input_ptr < end:
+		match = choices[input_ptr]
+		tokens.append(match)
+		input_ptr += match[0] or 1
+	return tokens
+
+class _TokenEncoder:
+	# Packs tokens into Wanwan's encoding, keeping flag bit state between calls
+	
+	def __init__(self):
+		self.output_data = bytearray()
+		self.flags_pointer = 0
+		self.flags_counter = 0
+	
+	def _write_flag_bit(self, b):
+		if self.flags_counter&7 == 0:
+			self.flags_counter = 0
+			self.flags_pointer = len(self.output_data)
+			self.output_data.append(0)
+		if b:
+			self.output_data[self.flags_pointer] |= 1 << self.flags_counter
+		self.flags_counter += 1
+	
+	def write_literal(self, b):
+		# Emit literal code for this character
+		self._write_flag_bit(1)
+		self.output_data.append(b)
+	
+	def write_copy(self, kind, match_offset, match_len):
+		# Emit copy codes for the match
+		output_data = self.output_data
+		self._write_flag_bit(0)
+		if kind == TOKEN_SHORT_COPY:
+			if match_offset < 1 or match_offset > SHORT_WINDOW_SIZE or match_len < 2 or match_len > MAX_SHORT_COPY_LENGTH:
+				raise ValueError(f"Can't encode short copy <{match_offset},{match_len}>")
+			self._write_flag_bit(1)
+			out_o = -match_offset+64
+			out_c = match_len-2
+			output_data.append(out_c<<6 | out_o)
+		elif kind == TOKEN_LONG_COPY:
+			if match_offset < 1 or match_offset > WINDOW_SIZE or match_len < 3 or match_len > MAX_LONG_COPY_LENGTH:
+				raise ValueError(f"Can't encode long copy <{match_offset},{match_len}>")
+			self._write_flag_bit(0)
+			out_o = -match_offset+4096
+			out_c = match_len-2
+			output_data.append(out_c<<4 | out_o>>8)
+			output_data.append(out_o&255)
+		elif kind == TOKEN_EXTENDED_COPY:
+			if match_offset < 1 or match_offset > WINDOW_SIZE or match_len < 3 or match_len > MAX_COPY_LENGTH:
+				raise ValueError(f"Can't encode extended copy <{match_offset},{match_len}>")
+			self._write_flag_bit(0)
+			out_o = -match_offset+4096
+			out_c = match_len-2
+			output_data.append(0 | out_o>>8)
+			output_data.append(out_o&255)
+			output_data.append(out_c&255)
+		else:
+			raise ValueError(f"Invalid token kind {kind}")
+	
+	def write_tokens(self, input_data, input_ptr, tokens):
+		# tokens is a list of (length, offset) copies, where length 0 is a literal
+		# Literals are read from input_data starting at input_ptr
+		# returns input_ptr after the last token
+		output_data = self.output_data
+		for match_len, match_offset in tokens:
+			if match_len > 0:
+				self.write_copy(_copy_kind(match_len, match_offset), match_offset, match_len)
+				input_ptr += match_len
+			elif self.flags_counter&7:
+				# Literals are the most common token, so set their flag bit inline when the flag byte already exists
+				output_data[self.flags_pointer] |= 1 << self.flags_counter
+				self.flags_counter += 1
+				output_data.append(input_data[input_ptr])
+				input_ptr += 1
+			else:
+				self.write_literal(input_data[input_ptr])
+				input_ptr += 1
+		return input_ptr
+	
+	def write_token_list(self, tokens):
+		# tokens is an LzssTokens, encoded with exactly the kinds it gives
+		literals = tokens.literals
+		literal_ptr = 0
+		for kind, match_offset, match_len in tokens:
+			if kind == TOKEN_LITERAL:
+				self.write_literal(literals[literal_ptr])
+				literal_ptr += 1
+			else:
+				self.write_copy(kind, match_offset, match_len)
+	
+	def write_eof(self):
+		# Emit EOF marker (long-extended copy with minimum length)
+		self._write_flag_bit(0)
+		self._write_flag_bit(0)
+		self.output_data.append(0x0F)
+		self.output_data.append(0xFF)
+		self.output_data.append(0x00)
+	
+	def take_output(self, final=False):
+		# Remove and return output up to the last flag byte that may still change
+		if final or self.flags_counter == 8:
+			cut = len(self.output_data)
+		else:
+			cut = self.flags_pointer
+		output_data = bytes(self.output_data[:cut])
+		del self.output_data[:cut]
+		self.flags_pointer -= cut
+		return output_data
+
+_PARSERS = [_parse_greedy, _parse_lazy, _parse_optimal]
+
+def _common_prefix_length(a, b):
+	# Count matching bytes at the start of a and b, by bisecting with slice compares
+	size = min(len(a), len(b))
+	if a[:size] == b[:size]:
+		return size
+	low = 0
+	high = size
+	while high-low > 1:
+		mid = (low+high)//2
+		if a[low:mid] == b[low:mid]:
+			low = mid
+		else:
+			high = mid
+	return low
+
+def compress(input_data, level=LEVEL_GREEDY, reuse_tokens=None):
+	# input_data is bytes, bytearray or memoryview input
+	# level is LEVEL_GREEDY (fastest), LEVEL_LAZY or LEVEL_OPTIMAL (smallest)
+	# reuse_tokens is an optional LzssTokens from an earlier version of the data,
+	# its tokens before the first changed byte are kept as they are
+	# returns compressed bytes
+	
+	if level < 0 or level >= len(_PARSERS):
+		raise ValueError(f"Invalid compression level {level}")
+	input_data = bytes(input_data)
+	encoder = _TokenEncoder()
+	start = 0
+	if reuse_tokens != None:
+		start = _common_prefix_length(reuse_tokens.decode(), input_data)
+		reuse_tokens = reuse_tokens.prefix(start)
+		encoder.write_token_list(reuse_tokens)
+		start = reuse_tokens.decoded_size()
+	tokens = _PARSERS[level](input_data, start)
+	encoder.write_tokens(input_data, start, tokens)
+	encoder.write_eof()
+	return encoder.output_data
+
+def decompress(input_data, debug=False, output_size=None):
+	# input_data is a bytes, bytearray or memoryview, must start with contain the entire data
+	# output_size is the expected decompressed size if known, used to preallocate the output
+	# returns uncompressed bytes to proper end, or None if error
+	
+	if debug:
+		tokens = tokenize(input_data)
+		if tokens == None:
+			return None
+		_print_tokens(tokens)
+	
+	input_view = memoryview(input_data)
+	input_size = len(input_view)
+	input_ptr = 0
+	output_data = bytearray(output_size or 0)
+	output_ptr = 0
+	
+	# Slice assignment past the preallocated size grows the output as needed
+	flags_buffer = 0
+	flags_counter = 0
+	try:
+		while True:
+			# Grab another flag byte when this one runs out
+			if flags_counter == 0:
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			
+			# Check the flag bit
+			# 0 = copy match
+			# 1 = literal byte
+			if flags_buffer & 1:
+				# Take the whole run of literal bits in this flag byte at once
+				count = (flags_buffer ^ (flags_buffer+1)).bit_length()-1
+				if input_ptr+count > input_size:
+					raise IndexError
+				output_data[output_ptr:output_ptr+count] = input_view[input_ptr:input_ptr+count]
+				input_ptr += count
+				output_ptr += count
+				flags_buffer >>= count
+				flags_counter -= count
+				continue
+			flags_buffer >>= 1
+			flags_counter -= 1
+			
+			# Grab another flag bit
+			# 0 = long copy
+			# 1 = short copy
+			if flags_counter == 0:
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			flag_shortcopy = flags_buffer & 1
+			flags_buffer >>= 1
+			flags_counter -= 1
+			if flag_shortcopy:
 				# Short copy
-				_write_flag_bit(1)
-				out_o = -match_offset+64
-				out_c = match_len-2
-				output_data.append(out_c<<6 | out_o)
-			elif match_offset <= 4096 and match_len >= 3 and match_len <= 257:
+				# next byte ccoooooo
+				# cc = count 2..5 (encoded 0..3)
+				# oooooo = offset -64..-1 (encoded 0..63)
+				shortcopy = input_view[input_ptr]
+				input_ptr += 1
+				copy_distance = 64-(shortcopy&63)
+				copy_count = shortcopy>>6
+			else:
 				# Long copy
-				_write_flag_bit(0)
-				out_o = -match_offset+4096
-				out_c = match_len-2
-				if match_len <= 17:
-					# Non-extended
-					output_data.append(out_c<<4 | out_o>>8)
-					output_data.append(out_o&255)
-				else:
-					# Extended
-					output_data.append(0 | out_o>>8)
-					output_data.append(out_o&255)
-					output_data.append(out_c&255)
+				# next 2 bytes ccccoooo oooooooo
+				# cccc = count 3..17 (encoded 1..15) or extended/EOF (encoded 0)
+				# oooooooooooo = offset -4096..-1 (encoded 0..4095)
+				longcopy_hi = input_view[input_ptr]
+				longcopy_lo = input_view[input_ptr+1]
+				input_ptr += 2
+				copy_distance = 4096-((longcopy_hi&15)<<8 | longcopy_lo)
+				copy_count = longcopy_hi>>4
+				if copy_count == 0:
+					# Extended count or EOF
+					# next byte = count 3..257 (encoded 1..255) or EOF (encoded 0)
+					copy_count = input_view[input_ptr]
+					input_ptr += 1
+					if copy_count == 0:
+						break
+			copy_count += 2
+			
+			# Copy from earlier output, repeating the pattern if the copy overlaps itself
+			copy_start = output_ptr-copy_distance
+			if copy_start < 0:
+				raise IndexError
+			if copy_distance >= copy_count:
+				output_data[output_ptr:output_ptr+copy_count] = output_data[copy_start:copy_start+copy_count]
 			else:
-				# Search should exclude this case
-				assert(False)
-		else:
-			# Emit literal code for this character
-			_write_flag_bit(1)
-			output_data.append(input_data[input_ptr])
-			input_ptr += 1
-	
-	# Emit EOF marker (long-extended copy with minimum length)
-	_write_flag_bit(0)
-	_write_flag_bit(0)
-	output_data.append(0x0F)
-	output_data.append(0xFF)
-	output_data.append(0x00)
+				pattern = output_data[copy_start:output_ptr]
+				output_data[output_ptr:output_ptr+copy_count] = (pattern * (copy_count//copy_distance+1))[:copy_count]
+			output_ptr += copy_count
+	except IndexError:
+		print("Decompression error. Input is corrupted, truncated, or not compressed.")
+		return None
+	del output_data[output_ptr:]
 	return output_data
 
-def decompress(input_data, debug=False):
-	# input_data is a bytes or bytearray, must start with contain the entire data
-	# returns uncompressed bytes to proper end, or None if error
+def probe(input_data):
+	# input_data is a bytes, bytearray or memoryview, must start with contain the entire data
+	# returns (compressed_length, decompressed_length, token_count) without decompressing,
+	# or None if the data isn't a valid stream (the EOF marker isn't counted as a token)
+	
+	input_view = memoryview(input_data)
+	input_ptr = 0
+	output_size = 0
+	token_count = 0
+	flags_buffer = 0
+	flags_counter = 0
+	try:
+		while True:
+			if flags_counter == 0:
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			
+			if flags_buffer & 1:
+				# Skip the whole run of literals, running past the end fails on the next read
+				count = (flags_buffer ^ (flags_buffer+1)).bit_length()-1
+				input_ptr += count
+				output_size += count
+				token_count += count
+				flags_buffer >>= count
+				flags_counter -= count
+				continue
+			flags_buffer >>= 1
+			flags_counter -= 1
+			
+			if flags_counter == 0:
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			flag_shortcopy = flags_buffer & 1
+			flags_buffer >>= 1
+			flags_counter -= 1
+			if flag_shortcopy:
+				shortcopy = input_view[input_ptr]
+				input_ptr += 1
+				copy_distance = 64-(shortcopy&63)
+				copy_count = shortcopy>>6
+			else:
+				longcopy_hi = input_view[input_ptr]
+				longcopy_lo = input_view[input_ptr+1]
+				input_ptr += 2
+				copy_distance = 4096-((longcopy_hi&15)<<8 | longcopy_lo)
+				copy_count = longcopy_hi>>4
+				if copy_count == 0:
+					copy_count = input_view[input_ptr]
+					input_ptr += 1
+					if copy_count == 0:
+						break
+			# Copies can't reach back before the start of the output
+			if copy_distance > output_size:
+				return None
+			output_size += copy_count+2
+			token_count += 1
+	except IndexError:
+		return None
+	return (input_ptr, output_size, token_count)
+
+class LzssTokens:
+	# Compact token list, as parallel arrays of kind, offset (copy distance) and length
+	# Literal tokens have offset 0 and length 1, their bytes are kept in order in literals
+	
+	def __init__(self):
+		self.kinds = array.array("B")
+		self.offsets = array.array("H")
+		self.lengths = array.array("H")
+		self.literals = bytearray()
+	
+	def __len__(self):
+		return len(self.kinds)
+	
+	def __getitem__(self, index):
+		return (self.kinds[index], self.offsets[index], self.lengths[index])
+	
+	def __iter__(self):
+		return zip(self.kinds, self.offsets, self.lengths)
 	
-	output_data = bytearray()
+	def append(self, kind, offset, length, literal=0):
+		self.kinds.append(kind)
+		self.offsets.append(offset)
+		self.lengths.append(length)
+		if kind == TOKEN_LITERAL:
+			self.literals.append(literal)
 	
-	# Create a stream for conveniently reading one byte at a time
-	with io.BytesIO(input_data) as input_stream:
-		# Set up convenience function for reading flag bits
-		flags_counter = 0
-		flags_buffer = 0
-		def _read_flag_bit():
-			nonlocal input_stream, flags_buffer, flags_counter
+	def decoded_size(self):
+		return sum(self.lengths)
+	
+	def prefix(self, size):
+		# returns the leading tokens that decode to at most size bytes
+		token_count = bisect.bisect_right(list(itertools.accumulate(self.lengths)), size)
+		tokens = LzssTokens()
+		tokens.kinds = self.kinds[:token_count]
+		tokens.offsets = self.offsets[:token_count]
+		tokens.lengths = self.lengths[:token_count]
+		tokens.literals = self.literals[:tokens.kinds.count(TOKEN_LITERAL)]
+		return tokens
+	
+	def decode(self):
+		# returns the decoded bytes
+		output_data = bytearray()
+		literals = self.literals
+		literal_ptr = 0
+		for kind, copy_distance, copy_count in self:
+			if kind == TOKEN_LITERAL:
+				output_data.append(literals[literal_ptr])
+				literal_ptr += 1
+				continue
+			copy_start = len(output_data)-copy_distance
+			if copy_distance >= copy_count:
+				output_data += output_data[copy_start:copy_start+copy_count]
+			else:
+				pattern = output_data[copy_start:]
+				output_data += (pattern * (copy_count//copy_distance+1))[:copy_count]
+		return output_data
+
+def tokenize(input_data):
+	# input_data is a bytes, bytearray or memoryview, must start with contain the entire data
+	# returns the tokens up to the EOF marker as LzssTokens, or None if error
+	
+	input_view = memoryview(input_data)
+	input_size = len(input_view)
+	input_ptr = 0
+	output_size = 0
+	tokens = LzssTokens()
+	kinds = tokens.kinds
+	offsets = tokens.offsets
+	lengths = tokens.lengths
+	literals = tokens.literals
+	flags_buffer = 0
+	flags_counter = 0
+	try:
+		while True:
 			if flags_counter == 0:
-				flags_buffer = input_stream.read(1)[0]
-			flags_counter = (flags_counter-1) & 7
-			flag = flags_buffer&1
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			
+			if flags_buffer & 1:
+				# Take the whole run of literals
+				count = (flags_buffer ^ (flags_buffer+1)).bit_length()-1
+				if input_ptr+count > input_size:
+					raise IndexError
+				kinds.extend([TOKEN_LITERAL]*count)
+				offsets.extend([0]*count)
+				lengths.extend([1]*count)
+				literals += input_view[input_ptr:input_ptr+count]
+				input_ptr += count
+				output_size += count
+				flags_buffer >>= count
+				flags_counter -= count
+				continue
 			flags_buffer >>= 1
-			return flag
+			flags_counter -= 1
+			
+			if flags_counter == 0:
+				flags_buffer = input_view[input_ptr]
+				input_ptr += 1
+				flags_counter = 8
+			flag_shortcopy = flags_buffer & 1
+			flags_buffer >>= 1
+			flags_counter -= 1
+			if flag_shortcopy:
+				shortcopy = input_view[input_ptr]
+				input_ptr += 1
+				kind = TOKEN_SHORT_COPY
+				copy_distance = 64-(shortcopy&63)
+				copy_count = shortcopy>>6
+			else:
+				longcopy_hi = input_view[input_ptr]
+				longcopy_lo = input_view[input_ptr+1]
+				input_ptr += 2
+				kind = TOKEN_LONG_COPY
+				copy_distance = 4096-((longcopy_hi&15)<<8 | longcopy_lo)
+				copy_count = longcopy_hi>>4
+				if copy_count == 0:
+					kind = TOKEN_EXTENDED_COPY
+					copy_count = input_view[input_ptr]
+					input_ptr += 1
+					if copy_count == 0:
+						break
+			if copy_distance > output_size:
+				raise IndexError
+			kinds.append(kind)
+			offsets.append(copy_distance)
+			lengths.append(copy_count+2)
+			output_size += copy_count+2
+	except IndexError:
+		print("Decompression error. Input is corrupted, truncated, or not compressed.")
+		return None
+	return tokens
+
+def encode_tokens(tokens):
+	# tokens is an LzssTokens, each token is encoded with the kind it gives
+	# returns compressed bytes
+	encoder = _TokenEncoder()
+	encoder.write_token_list(tokens)
+	encoder.write_eof()
+	return encoder.output_data
+
+def _print_tokens(tokens):
+	literals = tokens.literals
+	literal_ptr = 0
+	for kind, copy_distance, copy_count in tokens:
+		if kind == TOKEN_LITERAL:
+			print(f"{literals[literal_ptr]:02X} ", end="")
+			literal_ptr += 1
+		elif kind == TOKEN_SHORT_COPY:
+			print(f"<s/{copy_distance},{copy_count}> ", end="")
+		else:
+			print(f"<l/{copy_distance},{copy_count}> ", end="")
+	print(f"<eof>")
+
+def _map_parallel(func, items, workers):
+	# Run func over items in worker processes, returning results in input order
+	# Memoryviews can't be pickled, so those are copied once here, bytes go as they are
+	items = [bytes(x) if isinstance(x, memoryview) else x for x in items]
+	if workers == None:
+		workers = os.cpu_count() or 1
+	workers = max(1, min(workers, len(items)))
+	if workers == 1:
+		return [func(x) for x in items]
+	chunksize = max(1, len(items)//(workers*4))
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(func, items, chunksize=chunksize))
+
+def compress_many(inputs, workers=None, level=LEVEL_GREEDY):
+	# inputs is an iterable of bytes, bytearray or memoryview
+	# workers is the number of processes to use (default one per CPU)
+	# returns a list of compressed bytes in input order
+	if level < 0 or level >= len(_PARSERS):
+		raise ValueError(f"Invalid compression level {level}")
+	return _map_parallel(functools.partial(compress, level=level), inputs, workers)
+
+def decompress_many(inputs, workers=None):
+	# inputs is an iterable of bytes, bytearray or memoryview
+	# workers is the number of processes to use (default one per CPU)
+	# returns a list of decompressed bytes in input order, with None for any that failed
+	return _map_parallel(decompress, inputs, workers)
+
+class LzssCompressor:
+	# Incremental compressor in the style of zlib.compressobj
+	# Only the sliding window and a block of pending input are kept,
+	# compressed bytes are returned once their flag byte is complete
+	# Greedy and lazy output is identical to compress(), optimal is parsed per block
+	
+	def __init__(self, level=LEVEL_GREEDY):
+		if level < 0 or level >= len(_PARSERS):
+			raise ValueError(f"Invalid compression level {level}")
+		self._parse = _PARSERS[level]
+		self._buffer = b""
+		self._buffer_ptr = 0
+		self._encoder = _TokenEncoder()
+		self._finished = False
+	
+	def compress(self, data):
+		# Add more input, returns any compressed bytes now available
+		if self._finished:
+			raise ValueError("Compressor already flushed")
+		self._buffer += bytes(data)
+		# Hold back enough input that matches aren't cut short by the chunk boundary
+		if len(self._buffer)-self._buffer_ptr >= STREAM_BLOCK_SIZE+STREAM_LOOKAHEAD:
+			self._process(len(self._buffer)-STREAM_LOOKAHEAD)
+		return self._encoder.take_output()
+	
+	def flush(self):
+		# Finish the stream, returns the remaining compressed bytes including EOF marker
+		if self._finished:
+			raise ValueError("Compressor already flushed")
+		self._process(len(self._buffer))
+		self._encoder.write_eof()
+		self._finished = True
+		return self._encoder.take_output(final=True)
+	
+	def _process(self, end):
+		tokens = self._parse(self._buffer, self._buffer_ptr, end)
+		self._buffer_ptr = self._encoder.write_tokens(self._buffer, self._buffer_ptr, tokens)
+		# Drop input that has left the window
+		drop = self._buffer_ptr-WINDOW_SIZE
+		if drop > 0:
+			self._buffer = self._buffer[drop:]
+			self._buffer_ptr -= drop
+
+class LzssDecompressor:
+	# Incremental decompressor in the style of lzma.LZMADecompressor
+	# Only the sliding window and unconsumed input are kept
+	# Input after the EOF marker is left in unused_data
+	
+	def __init__(self):
+		self.eof = False
+		self.needs_input = True
+		self.unused_data = b""
+		self._input = b""
+		self._history = bytearray()
+		self._flags_buffer = 0
+		self._flags_counter = 0
+		self._copy_distance = 0
+		self._copy_remaining = 0
+	
+	def decompress(self, data, max_length=-1):
+		# Add more input, returns decompressed bytes now available, or None if error
+		# If max_length is nonnegative at most that many bytes are returned, and
+		# needs_input is False if more output can be had by passing b"" again
+		if self.eof:
+			raise EOFError("End of stream already reached")
+		input_data = self._input + bytes(data)
+		input_view = memoryview(input_data)
+		input_size = len(input_view)
+		input_ptr = 0
+		output_data = self._history
+		output_start = len(output_data)
+		output_end = output_start+max_length if max_length >= 0 else -1
+		flags_buffer = self._flags_buffer
+		flags_counter = self._flags_counter
+		copy_distance = self._copy_distance
+		copy_remaining = self._copy_remaining
 		
-		# Do decompression unless an error occurs
 		try:
 			while True:
-				# Grab another flag bit
-				# 0 = copy match
-				# 1 = literal byte
-				flag_literal = _read_flag_bit()
-				if flag_literal:
-					b = input_stream.read(1)[0]
-					output_data.append(b)
-					if debug:
-						print(f"{b:02X} ", end="")
-				else:
-					# Grab another flag bit
-					# 0 = long copy
-					# 1 = short copy
-					flag_shortcopy = _read_flag_bit()
-					copy_offset = 0
-					copy_count = 0
+				# Finish any copy left over from the previous call or the previous token
+				if copy_remaining > 0:
+					copy_count = copy_remaining
+					if output_end >= 0:
+						copy_count = min(copy_count, output_end-len(output_data))
+					copy_start = len(output_data)-copy_distance
+					if copy_distance >= copy_count:
+						output_data += output_data[copy_start:copy_start+copy_count]
+					else:
+						pattern = output_data[copy_start:]
+						output_data += (pattern * (copy_count//copy_distance+1))[:copy_count]
+					copy_remaining -= copy_count
+				if len(output_data) == output_end:
+					break
+				
+				# Remember where this token starts in case the input runs out partway
+				token_state = (input_ptr, flags_buffer, flags_counter)
+				try:
+					# Grab another flag byte when this one runs out
+					if flags_counter == 0:
+						flags_buffer = input_view[input_ptr]
+						input_ptr += 1
+						flags_counter = 8
+					
+					if flags_buffer & 1:
+						# Take as much of the run of literals as is available
+						count = (flags_buffer ^ (flags_buffer+1)).bit_length()-1
+						count = min(count, input_size-input_ptr)
+						if output_end >= 0:
+							count = min(count, output_end-len(output_data))
+						if count == 0:
+							raise IndexError
+						output_data += input_view[input_ptr:input_ptr+count]
+						input_ptr += count
+						flags_buffer >>= count
+						flags_counter -= count
+						continue
+					flags_buffer >>= 1
+					flags_counter -= 1
+					
+					if flags_counter == 0:
+						flags_buffer = input_view[input_ptr]
+						input_ptr += 1
+						flags_counter = 8
+					flag_shortcopy = flags_buffer & 1
+					flags_buffer >>= 1
+					flags_counter -= 1
 					if flag_shortcopy:
-						# Short copy
-						# next byte ccoooooo
-						# cc = count 2..5 (encoded 0..3)
-						# oooooo = offset -64..-1 (encoded 0..63)
-						shortcopy = input_stream.read(1)[0]
-						copy_offset = (shortcopy&63)-64
-						copy_count = (shortcopy>>6)&3
-						if debug:
-							print(f"<s/{-copy_offset},{copy_count+2}> ", end="")
+						shortcopy = input_view[input_ptr]
+						input_ptr += 1
+						copy_distance = 64-(shortcopy&63)
+						copy_count = shortcopy>>6
 					else:
-						# Long copy
-						# next 2 bytes ccccoooo oooooooo
-						# cccc = count 3..17 (encoded 1..15) or extended/EOF (encoded 0)
-						# oooooooooooo = offset -4096..-1 (encoded 0..4095)
-						longcopy = struct.unpack(">H",input_stream.read(2))[0]
-						copy_offset = (longcopy&4095)-4096
-						copy_count = (longcopy>>12)&15
+						longcopy_hi = input_view[input_ptr]
+						longcopy_lo = input_view[input_ptr+1]
+						input_ptr += 2
+						copy_distance = 4096-((longcopy_hi&15)<<8 | longcopy_lo)
+						copy_count = longcopy_hi>>4
 						if copy_count == 0:
-							# Extended count or EOF
-							# next byte = count 3..257 (encoded 1..255) or EOF (encoded 0)
-							copy_count = input_stream.read(1)[0]
+							copy_count = input_view[input_ptr]
+							input_ptr += 1
 							if copy_count == 0:
-								if debug:
-									print(f"<eof>")
+								self.eof = True
 								break
-						if debug:
-							print(f"<l/{-copy_offset},{copy_count+2}> ", end="")
-					for i in range(copy_count+2):
-						output_data.append(output_data[copy_offset:][0])
-		except (IndexError, struct.error):
-			print("Decompression error. Input is corrupted, truncated, or not compressed.")
-			return None
-	return output_data
+				except IndexError:
+					# Wait for more input
+					input_ptr, flags_buffer, flags_counter = token_state
+					break
+				
+				# Copy the match on the next pass, cut short by max_length if needed
+				if copy_distance > len(output_data):
+					print("Decompression error. Input is corrupted, truncated, or not compressed.")
+					return None
+				copy_remaining = copy_count+2
+		finally:
+			input_view.release()
+		
+		# Keep only the window for later copies
+		limit_reached = len(output_data) == output_end
+		output = bytes(output_data[output_start:])
+		del output_data[:max(0, len(output_data)-WINDOW_SIZE)]
+		if self.eof:
+			self.unused_data = input_data[input_ptr:]
+			self._input = b""
+			self.needs_input = False
+		else:
+			self._input = input_data[input_ptr:]
+			self.needs_input = not limit_reached
+		self._flags_buffer = flags_buffer
+		self._flags_counter = flags_counter
+		self._copy_distance = copy_distance
+		self._copy_remaining = copy_remaining
+		return output
 
 def run_self_test(benchmark_only=False):
 	test_lengths = [0, -1, 100, 1000, 5000]
@@ -188,22 +947,23 @@ def run_self_test(benchmark_only=False):
 				elif tl < 0:
 					ro = rng.randint(0, 256)
 					x = bytes([(i+ro)&255 for i in range(256)])
-				y = ww_lzss_compress(x)
-				if y == None:
-					print("X:"+_hexstr(x))
-					print("Failed to compress the above data")
-					return
-				z = ww_lzss_decompress(y)
-				if z == None:
-					print("X:"+_hexstr(x))
-					print("Y:"+_hexstr(y))
-					print("Failed to decompress the above data")
-					return
-				if x != z:
-					print("X:"+_hexstr(x))
-					print("Failed to round-trip the above data")
-					return
-				print(f"{len(x)} -> {len(y)} -> {len(z)} PASS")
+				for level in range(len(LEVEL_NAMES)):
+					y = compress(x, level)
+					if y == None:
+						print("X:"+_hexstr(x))
+						print(f"Failed to compress the above data ({LEVEL_NAMES[level]})")
+						return
+					z = decompress(y)
+					if z == None:
+						print("X:"+_hexstr(x))
+						print("Y:"+_hexstr(y))
+						print(f"Failed to decompress the above data ({LEVEL_NAMES[level]})")
+						return
+					if x != z:
+						print("X:"+_hexstr(x))
+						print(f"Failed to round-trip the above data ({LEVEL_NAMES[level]})")
+						return
+					print(f"{len(x)} -> {len(y)} -> {len(z)} PASS ({LEVEL_NAMES[level]})")
 		print("All tests passed")
 	benchmark_length = 256*224+2
 	benchmark_repeats = 5
@@ -216,10 +976,10 @@ def run_self_test(benchmark_only=False):
 		print(f"Run {tr+1}...")
 		x = bytes([rng.randint(0, random_range-1) for k in range(benchmark_length)])
 		ts = time.time()
-		y = ww_lzss_compress(x)
+		y = compress(x)
 		time_compress = time.time()-ts
 		ts = time.time()
-		z = ww_lzss_decompress(y)
+		z = decompress(y)
 		time_decompress = time.time()-ts
 		ratio = len(y)/len(x)
 		sum_time_compress += time_compress
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from util import col2rgb_array, rgb2col_array, nearest_color_indices
+
+# Nearest-color lookup tables for RGB555 palettes
+# Each table maps all 32768 RGB555 colors to their nearest palette index, so quantizing an image to a palette
+# is one table lookup per pixel. Tables are memoised in memory, and optionally persisted in a cache directory
+# keyed by a hash of the palette, since the same few palettes are reused across many images
+# Pixels are reduced to RGB555 before the lookup, so an 8-bit color can map to a slightly less near palette color
+# than an exact search would give
+
+PALETTE_LUT_VERSION = 1
+PALETTE_LUT_SIZE = 0x8000
+PALETTE_LUT_SUFFIX = ".pallut"
+# Squared channel differences are scaled by these when matching perceptually, as the eye is most sensitive to green
+PERCEPTUAL_WEIGHTS = (2, 4, 3)
+
+_memo = {}
+
+def _palette_key(palette, weighted):
+	h = hashlib.blake2b(digest_size=20)
+	h.update(f"palette_lut/{PALETTE_LUT_VERSION}/{'weighted' if weighted else 'plain'}/".encode("ascii"))
+	h.update(np.asarray(palette, dtype=">u2").tobytes())
+	return h.hexdigest()
+
+def build_palette_lut(palette, weighted=False):
+	# Search the nearest palette color for every RGB555 color, comparing colors as expanded to 8 bits per channel
+	# returns a uint8 array of PALETTE_LUT_SIZE palette indices
+	if len(palette) < 1 or len(palette) > 256:
+		raise ValueError("Palette size out of range")
+	all_rgb = col2rgb_array(np.arange(PALETTE_LUT_SIZE))
+	palette_rgb = col2rgb_array(palette)
+	return nearest_color_indices(all_rgb, palette_rgb, PERCEPTUAL_WEIGHTS if weighted else None)
+
+class PaletteLutCache:
+	def __init__(self, cache_dir):
+		self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key+PALETTE_LUT_SUFFIX)
+
+	def get(self, key):
+		# returns the cached table, or None if not cached
+		try:
+			with open(self._path(key), "rb") as f:
+				lut_data = f.read()
+		except OSError:
+			return None
+		if len(lut_data) != PALETTE_LUT_SIZE:
+			return None
+		return np.frombuffer(lut_data, dtype=np.uint8)
+
+	def put(self, key, lut):
+		# Write to a temporary file and rename, so readers never see a partial entry
+		fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(lut.tobytes())
+			os.replace(temp_path, self._path(key))
+		except OSError:
+			try:
+				os.remove(temp_path)
+			except OSError:
+				pass
+
+def palette_lut(palette, weighted=False, cache_dir=None):
+	# returns the read-only nearest-color table for a list of RGB555 colors, from memory, the cache in cache_dir,
+	# or built and cached if needed
+	key = _palette_key(palette, weighted)
+	lut = _memo.get(key)
+	if lut is not None:
+		return lut
+	cache = PaletteLutCache(cache_dir) if cache_dir else None
+	if cache:
+		lut = cache.get(key)
+	if lut is None:
+		lut = build_palette_lut(palette, weighted)
+		if cache:
+			cache.put(key, lut)
+	lut.flags.writeable = False
+	_memo[key] = lut
+	return lut
+
+def quantize_to_palette(rgb, palette, weighted=False, cache_dir=None):
+	# Map an array with a trailing axis of r, g, b to the nearest colors of an RGB555 palette
+	# Pixels are reduced to RGB555 first, so every pixel is a single table lookup
+	# returns a uint8 array of palette indices with the shape of the pixels
+	return palette_lut(palette, weighted, cache_dir)[rgb2col_array(rgb)]
@@ -0,0 +1,98 @@
+import numpy as np
+from util import rgb2col_array
+
+# Palette derivation in RGB555 space
+# Pixels are counted into a histogram of the 32768 RGB555 colors, so colors that are only distinct at 8 bits
+# per channel never take separate palette slots. Median cut splits the histogram into boxes, and k-means
+# optionally refines the box colors, working on the occupied histogram bins rather than on pixels
+
+METHOD_NAMES = ["median-cut", "k-means"]
+METHOD_MEDIAN_CUT = 0
+METHOD_KMEANS = 1
+HISTOGRAM_SIZE = 0x8000
+
+def color_histogram(rgb_arrays):
+	# Count the RGB555 colors of one or more arrays with a trailing axis of r, g, b
+	# returns an int64 array of HISTOGRAM_SIZE counts
+	hist = np.zeros(HISTOGRAM_SIZE, dtype=np.int64)
+	for rgb in rgb_arrays:
+		hist += np.bincount(rgb2col_array(rgb).ravel(), minlength=HISTOGRAM_SIZE)
+	return hist
+
+def _histogram_colors(hist):
+	# returns the occupied colors as an (n, 3) array of 5-bit components, and their counts
+	cols = np.nonzero(hist)[0]
+	rgb5 = np.stack([(cols>>10)&31, (cols>>5)&31, cols&31], axis=1).astype(np.float64)
+	return rgb5, hist[cols].astype(np.float64)
+
+def _to_rgb555(rgb5):
+	# Round 5-bit component centers to distinct RGB555 colors
+	c5 = np.clip(np.rint(rgb5), 0, 31).astype(np.int32)
+	return np.unique(c5[:,0]<<10 | c5[:,1]<<5 | c5[:,2]).astype(np.uint16)
+
+def _box_error(rgb5, counts, weights):
+	# Weighted sum of squared distances from the box mean, per channel
+	mean = (rgb5*counts[:,None]).sum(axis=0)/counts.sum()
+	return (((rgb5-mean)**2)*counts[:,None]).sum(axis=0)*weights
+
+def median_cut(hist, num_colors, weights=None):
+	# Repeatedly split the box with the largest error at the weighted median of the channel with the most error
+	# returns the box mean colors as an (n, 3) array of 5-bit components, with n <= num_colors
+	weights = np.ones(3) if weights is None else np.asarray(weights, dtype=np.float64)
+	rgb5, counts = _histogram_colors(hist)
+	if len(counts) == 0:
+		return np.zeros((0, 3))
+	boxes = [np.arange(len(counts))]
+	errors = [_box_error(rgb5, counts, weights)]
+	while len(boxes) < num_colors:
+		box_index = max(range(len(boxes)), key=lambda i: errors[i].sum())
+		if errors[box_index].sum() == 0:
+			break
+		box = boxes[box_index]
+		axis = int(np.argmax(errors[box_index]))
+		box = box[np.argsort(rgb5[box,axis], kind="stable")]
+		# Split between distinct values, so both halves are nonempty and no color is divided
+		cum = np.cumsum(counts[box])
+		split = int(np.searchsorted(cum, cum[-1]/2))
+		values = rgb5[box,axis]
+		split = int(np.searchsorted(values, values[split], side="right"))
+		if split == len(box):
+			split = int(np.searchsorted(values, values[-1], side="left"))
+		halves = [box[:split], box[split:]]
+		boxes[box_index:box_index+1] = halves
+		errors[box_index:box_index+1] = [_box_error(rgb5[h], counts[h], weights) for h in halves]
+	return np.array([(rgb5[box]*counts[box,None]).sum(axis=0)/counts[box].sum() for box in boxes])
+
+def kmeans_refine(hist, centers, iterations, weights=None):
+	# Move centers to the weighted mean of the histogram colors nearest to them, until assignments settle
+	# Centers left without colors keep their place
+	# returns the refined centers as an (n, 3) array of 5-bit components
+	weights = np.ones(3) if weights is None else np.asarray(weights, dtype=np.float64)
+	rgb5, counts = _histogram_colors(hist)
+	centers = np.array(centers, dtype=np.float64)
+	if len(counts) == 0 or len(centers) == 0:
+		return centers
+	rgb5_single = rgb5.astype(np.float32)
+	assign = None
+	for i in range(iterations):
+		# Squared distance with the constant |c|^2 dropped, as a single precision matrix product
+		dist = rgb5_single @ (-2*centers*weights).T.astype(np.float32)
+		dist += ((centers*centers) @ weights).astype(np.float32)
+		new_assign = np.argmin(dist, axis=1)
+		if assign is not None and np.array_equal(assign, new_assign):
+			break
+		assign = new_assign
+		totals = np.bincount(assign, weights=counts, minlength=len(centers))
+		used = totals > 0
+		for axis in range(3):
+			sums = np.bincount(assign, weights=counts*rgb5[:,axis], minlength=len(centers))
+			centers[used,axis] = sums[used]/totals[used]
+	return centers
+
+def derive_palette(hist, num_colors, method=METHOD_KMEANS, iterations=16, weights=None):
+	# Derive up to num_colors distinct RGB555 colors for a histogram
+	# returns a uint16 array of colors, empty if the histogram is
+	centers = median_cut(hist, num_colors, weights)
+	if method == METHOD_KMEANS:
+		centers = kmeans_refine(hist, centers, iterations, weights)
+	return _to_rgb555(centers)
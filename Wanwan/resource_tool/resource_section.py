@@ -0,0 +1,160 @@
+import bisect
+import struct
+from util import is_filled, strip_fill
+from lzss_ww import probe
+
+# Parsed view of a resource section
+# The pointer table is read once, and each resource's offset and size is precomputed from the sorted distinct pointers,
+# so lookups are O(1) per index and resource data is returned as memoryview slices without copying
+
+ROM_BASE = 0x0E000000
+RESOURCES_SECTION_PTR = 0x70000
+RESOURCES_SECTION_DEFAULT_MAX = 0x200000-RESOURCES_SECTION_PTR
+RESOURCES_SECTION_HARD_LIMIT = 0x400000-RESOURCES_SECTION_PTR
+SECTION_PAD_VALUE = 0xFF
+ROM_PAD_VALUE = 0xFF
+ROM_MAGIC = b"\x0E\x00\x00\x80"
+
+RESOURCE_TYPE_UNKNOWN = "unknown"
+RESOURCE_TYPE_PALETTE = "palette"
+RESOURCE_TYPE_BITMAP = "bitmap"
+RESOURCE_TYPE_METASPRITE = "metasprite"
+RESOURCE_TYPE_TILESHEET = "tilesheet"
+RESOURCE_TYPE_TILEMAP = "tilemap"
+
+def guess_resource_type(header, size, compressed):
+	# Guess a resource type from its first few bytes and (decompressed) size, following resource structures.txt
+	# Uncompressed resources may have up to 3 bytes of alignment padding included in size
+	if len(header) < 4:
+		return RESOURCE_TYPE_UNKNOWN
+	u16a, u16b = struct.unpack(">HH", header[:4])
+	width = header[0] or 256
+	height = header[1] or 256
+	if compressed:
+		if size == 2+u16a*32:
+			return RESOURCE_TYPE_TILESHEET
+		if size == 2+width*height*2:
+			return RESOURCE_TYPE_TILEMAP
+		if size == 2+width*height:
+			return RESOURCE_TYPE_BITMAP
+	else:
+		if u16a > 0 and 0 <= size-(2+u16a*2) < 4:
+			return RESOURCE_TYPE_PALETTE
+		if u16a != 0 and u16b == 4 and len(header) >= 5 and 0 <= size-(5+header[4]*4) < 4:
+			return RESOURCE_TYPE_METASPRITE
+	return RESOURCE_TYPE_UNKNOWN
+
+def find_compressed_stream(res_data):
+	# Returns the compressed and decompressed size of the LZSS stream filling this resource, or None if it isn't one
+	# Only padding may follow the stream, so raw data that happens to decode is skipped
+	# Resources patched in-place can have more than the usual alignment padding after them
+	res_probe = probe(res_data)
+	if not res_probe or res_probe[1] == 0:
+		return None
+	comp_size = res_probe[0]
+	if not is_filled(res_data[comp_size:], SECTION_PAD_VALUE):
+		return None
+	return (comp_size, res_probe[1])
+
+def is_rom(data):
+	return len(data) >= RESOURCES_SECTION_PTR+4 and data[:4] == ROM_MAGIC
+
+def find_section_size(rom_data):
+	# Find where the resource section ends in a ROM, by stripping the trailing ROM padding
+	# The size never cuts into the pointer table or the start of the last resource, and is rounded up to alignment
+	# returns the size, or None if there is no valid pointer table
+	sec_data = rom_data[RESOURCES_SECTION_PTR:]
+	if len(sec_data) < 4:
+		return None
+	res_count = struct.unpack(">I", sec_data[:4])[0]
+	if 4+(res_count*4) > len(sec_data):
+		return None
+	res_table = struct.unpack(f">{res_count}I", sec_data[4:4+(res_count*4)])
+	min_size = max([4+(res_count*4)] + [p-(ROM_BASE+RESOURCES_SECTION_PTR)+1 for p in res_table if p >= ROM_BASE+RESOURCES_SECTION_PTR])
+	if min_size > len(sec_data):
+		return None
+	sec_size = max(min_size, strip_fill(sec_data, ROM_PAD_VALUE))
+	return min((sec_size+3) & ~3, len(sec_data))
+
+class ResourceSection:
+	def __init__(self, sec_data, res_count, res_table, base=0):
+		# base is the file offset of the section, nonzero when it is accessed inside a ROM
+		self.data = memoryview(sec_data)
+		self.base = base
+		self.count = res_count
+		self.table = res_table
+		self.offsets = [-1]*res_count
+		self.sizes = [0]*res_count
+
+		# Each resource runs up to the next distinct pointer above it, or the end of the section
+		sec_ptr = ROM_BASE+RESOURCES_SECTION_PTR
+		sorted_ptrs = sorted(set(res_table))
+		for i, res_ptr in enumerate(res_table):
+			if res_ptr < sec_ptr:
+				continue
+			next_index = bisect.bisect_right(sorted_ptrs, res_ptr)
+			res_offset = res_ptr-sec_ptr
+			if next_index < len(sorted_ptrs):
+				res_size = sorted_ptrs[next_index]-res_ptr
+			else:
+				res_size = len(sec_data)-res_offset
+			self.offsets[i] = res_offset
+			self.sizes[i] = res_size
+
+	@staticmethod
+	def parse(sec_data, base=0):
+		# Load count and table, ensure input is sane
+		# returns a ResourceSection, or None after printing the problem
+		if len(sec_data) < 4:
+			print("Size too small, can't read resource count")
+			return None
+		res_count = struct.unpack(">I", sec_data[:4])[0]
+		if 4+(res_count*4) > len(sec_data):
+			print("Size too small, can't read resource table")
+			return None
+		res_table = struct.unpack(f">{res_count}I", sec_data[4:4+(res_count*4)])
+
+		# Validate input size contains at least the start address for all resources
+		max_ptr = max(0, max(res_table, default=0)-ROM_BASE-RESOURCES_SECTION_PTR)
+		if max_ptr >= len(sec_data):
+			print("Size too small, some pointers are excluded")
+			return None
+
+		return ResourceSection(sec_data, res_count, res_table, base)
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, res_index):
+		# returns a memoryview of the resource data, or None for a null resource
+		res_offset = self.offsets[res_index]
+		if res_offset < 0:
+			return None
+		return self.data[res_offset:res_offset+self.sizes[res_index]]
+
+	def __iter__(self):
+		for res_index in range(self.count):
+			yield self[res_index]
+
+	def in_range(self, res_index):
+		return res_index >= 0 and res_index < self.count
+
+	def is_null(self, res_index):
+		return self.offsets[res_index] < 0
+
+	def ptr(self, res_index):
+		# returns the ROM address of the resource, or 0 for a null resource
+		res_offset = self.offsets[res_index]
+		if res_offset < 0:
+			return 0
+		return ROM_BASE+RESOURCES_SECTION_PTR+res_offset
+
+	def offset(self, res_index):
+		return self.offsets[res_index]
+
+	def size(self, res_index):
+		return self.sizes[res_index]
+
+	def resources(self):
+		# returns a list of memoryviews in index order, with None for null resources
+		return list(self)
@@ -30,7 +30,7 @@ def main(args):
 	parser_extract_sec.set_defaults(action=afunc)
 	parser_extract_sec.add_argument("path_rom_in", metavar="rom.bin", help="Source ROM input path")
 	parser_extract_sec.add_argument("path_sec_out", metavar="resources.bin", help="Resource section output path")
-	parser_extract_sec.add_argument("sec_size", metavar="sec_size", help="Size of the resource section", type=parsenum)
+	parser_extract_sec.add_argument("sec_size", metavar="sec_size", help="Size of the resource section (default detected from the end padding)", type=parsenum, nargs="?", default=-1)
 	
 	aname = "inject-section"
 	ahelp = "Inject a resource section to a ROM file"
@@ -48,7 +48,7 @@ def main(args):
 	afunc = cmd_extract_res
 	parser_extract_res = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
 	parser_extract_res.set_defaults(action=afunc)
-	parser_extract_res.add_argument("path_sec_in", metavar="resources.bin", help="Resource section input path")
+	parser_extract_res.add_argument("path_sec_in", metavar="resources.bin", help="Resource section or ROM input path")
 	parser_extract_res.add_argument("res_index", metavar="res_index", help="Resource number to extract", type=parsenum)
 	parser_extract_res.add_argument("path_res_out", metavar="output.bin", help="Resource file output path")
 	parser_extract_res.add_argument("-c", "--compressed", metavar="true/false", help="Decompress resource on extraction (default false)", dest="compressed", type=parsebool, default=False)
@@ -58,13 +58,88 @@ def main(args):
 	afunc = cmd_inject_res
 	parser_inject_res = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
 	parser_inject_res.set_defaults(action=afunc)
-	parser_inject_res.add_argument("path_sec_in", metavar="resources.bin", help="Resource section input path")
+	parser_inject_res.add_argument("path_sec_in", metavar="resources.bin", help="Resource section or ROM input path")
 	parser_inject_res.add_argument("path_res_in", metavar="input.bin", help="Resource file input path")
 	parser_inject_res.add_argument("res_index", metavar="res_index", help="Resource number to inject, or -1 to append", type=parsenum)
-	parser_inject_res.add_argument("path_sec_out", metavar="resources_out.bin", help="Modified resource section output path, or \"@\" to inject in-place")
+	parser_inject_res.add_argument("path_sec_out", metavar="resources_out.bin", help="Modified resource section or ROM output path, or \"@\" to inject in-place")
 	parser_inject_res.add_argument("-c", "--compressed", metavar="true/false", help="Compress resource on injection (default false)", dest="compressed", type=parsebool, default=False)
+	parser_inject_res.add_argument("-k", "--cache", metavar="cache_dir", help="Directory to cache compressed resources in (default none)", dest="cache", default=None)
+	parser_inject_res.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 0)", dest="level", type=parsenum, default=0)
 	parser_inject_res.add_argument("-m", "--max_size", metavar="max_size", help=f"Maximum section size (default based on original ROM size)", dest="max_size", type=parsenum, default=-1)
 	
+	aname = "recompress-section"
+	ahelp = "Recompress every compressed resource in a resource section to reclaim space"
+	afunc = cmd_recompress_sec
+	parser_recompress_sec = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_recompress_sec.set_defaults(action=afunc)
+	parser_recompress_sec.add_argument("path_sec_in", metavar="resources.bin", help="Resource section or ROM input path")
+	parser_recompress_sec.add_argument("path_sec_out", metavar="resources_out.bin", help="Recompressed resource section or ROM output path, or \"@\" to recompress in-place")
+	parser_recompress_sec.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 2)", dest="level", type=parsenum, default=2)
+	parser_recompress_sec.add_argument("-m", "--max_size", metavar="max_size", help=f"Maximum section size (default based on original ROM size)", dest="max_size", type=parsenum, default=-1)
+	parser_recompress_sec.add_argument("-w", "--workers", metavar="workers", help="Number of worker processes (default one per CPU)", dest="workers", type=parsenum, default=-1)
+	
+	aname = "extract-all"
+	ahelp = "Extract every resource from a resource section with a manifest"
+	afunc = cmd_extract_all
+	parser_extract_all = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_extract_all.set_defaults(action=afunc)
+	parser_extract_all.add_argument("path_sec_in", metavar="resources.bin", help="Resource section or ROM input path")
+	parser_extract_all.add_argument("path_out_dir", metavar="outdir", help="Resource files output directory")
+	parser_extract_all.add_argument("-c", "--compressed", metavar="true/false", help="Decompress compressed resources on extraction (default false)", dest="compressed", type=parsebool, default=False)
+	parser_extract_all.add_argument("-m", "--manifest", metavar="manifest", help="Manifest output path, .json or .csv (default outdir/manifest.json)", dest="manifest", default=None)
+	parser_extract_all.add_argument("-w", "--workers", metavar="workers", help="Number of worker processes (default one per CPU)", dest="workers", type=parsenum, default=-1)
+	
+	aname = "build-section"
+	ahelp = "Build a whole resource section from a manifest"
+	afunc = cmd_build_sec
+	parser_build_sec = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_build_sec.set_defaults(action=afunc)
+	parser_build_sec.add_argument("path_manifest_in", metavar="manifest", help="Manifest input path (.json or .csv with index, file and compress for each resource)")
+	parser_build_sec.add_argument("path_sec_out", metavar="resources_out.bin", help="Resource section output path")
+	parser_build_sec.add_argument("-k", "--cache", metavar="cache_dir", help="Directory to cache compressed resources in (default none)", dest="cache", default=None)
+	parser_build_sec.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 0)", dest="level", type=parsenum, default=0)
+	parser_build_sec.add_argument("-m", "--max_size", metavar="max_size", help=f"Maximum section size (default based on original ROM size)", dest="max_size", type=parsenum, default=-1)
+	parser_build_sec.add_argument("-w", "--workers", metavar="workers", help="Number of worker processes (default one per CPU)", dest="workers", type=parsenum, default=-1)
+	
+	aname = "index-section"
+	ahelp = "Save an index of every resource in a resource section for later actions to reuse"
+	afunc = cmd_index_sec
+	parser_index_sec = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_index_sec.set_defaults(action=afunc)
+	parser_index_sec.add_argument("path_sec_in", metavar="resources.bin", help="Resource section or ROM input path")
+	parser_index_sec.add_argument("-o", "--output", metavar="index.json", help=f"Index output path (default resources.bin{INDEX_SUFFIX}, where other actions look for it)", dest="path_index_out", default=None)
+	
+	aname = "diff-sections"
+	ahelp = "List resources that differ between two resource sections"
+	afunc = cmd_diff_sec
+	parser_diff_sec = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_diff_sec.set_defaults(action=afunc)
+	parser_diff_sec.add_argument("path_sec_a", metavar="a.bin", help="Old resource section or ROM path")
+	parser_diff_sec.add_argument("path_sec_b", metavar="b.bin", help="New resource section or ROM path")
+	parser_diff_sec.add_argument("-d", "--decompressed", metavar="true/false", help="Compare compressed resources by their decompressed data (default false)", dest="decompressed", type=parsebool, default=False)
+	parser_diff_sec.add_argument("-w", "--workers", metavar="workers", help="Number of worker processes (default one per CPU)", dest="workers", type=parsenum, default=-1)
+	
+	aname = "make-delta"
+	ahelp = "Make a delta patch holding only the resources and ROM data that changed between two resource sections or ROMs"
+	afunc = cmd_make_delta
+	parser_make_delta = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_make_delta.set_defaults(action=afunc)
+	parser_make_delta.add_argument("path_sec_old", metavar="old.bin", help="Old resource section or ROM path")
+	parser_make_delta.add_argument("path_sec_new", metavar="new.bin", help="New resource section or ROM path")
+	parser_make_delta.add_argument("path_delta_out", metavar="out.delta", help="Delta output path")
+	parser_make_delta.add_argument("-c", "--compressed", metavar="true/false", help="Compress changed resources in the delta (default false)", dest="compressed", type=parsebool, default=False)
+	parser_make_delta.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 0)", dest="level", type=parsenum, default=0)
+	parser_make_delta.add_argument("-w", "--workers", metavar="workers", help="Number of worker processes (default one per CPU)", dest="workers", type=parsenum, default=-1)
+	
+	aname = "apply-delta"
+	ahelp = "Apply a delta patch to a resource section or ROM"
+	afunc = cmd_apply_delta
+	parser_apply_delta = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
+	parser_apply_delta.set_defaults(action=afunc)
+	parser_apply_delta.add_argument("path_sec_old", metavar="old.bin", help="Old resource section or ROM path")
+	parser_apply_delta.add_argument("path_delta_in", metavar="in.delta", help="Delta input path")
+	parser_apply_delta.add_argument("path_sec_out", metavar="new.bin", help="New resource section or ROM output path")
+	
 	aname = "decode-image"
 	ahelp = "Decode an 8bpp image"
 	afunc = cmd_decode_image
@@ -88,7 +163,11 @@ def main(args):
 	parser_enc_image.add_argument("-c", "--compressed", metavar="true/false", help="Compress image resource on save (default true)", dest="compressed", type=parsebool, default=True)
 	parser_enc_image.add_argument("-d", "--dither", metavar="true/false", help="Dither image when quantizing (default false)", dest="dither", type=parsebool, default=False)
 	parser_enc_image.add_argument("-i", "--indexed", metavar="true/false", help="Read an indexed-color image and ignore palette (default false)", dest="indexed", type=parsebool, default=False)
+	parser_enc_image.add_argument("-k", "--cache", metavar="cache_dir", help="Directory to cache compressed resources and palette tables in (default none)", dest="cache", default=None)
+	parser_enc_image.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 0)", dest="level", type=parsenum, default=0)
 	parser_enc_image.add_argument("-t", "--transparent", metavar="true/false", help="Color 0 is transparent (default false)", dest="transparent", type=parsebool, default=False)
+	parser_enc_image.add_argument("-u", "--table", metavar="true/false", help="Match colors with a cached RGB555 lookup table, faster for reused palettes but slightly less exact (default false)", dest="table", type=parsebool, default=False)
+	parser_enc_image.add_argument("-w", "--weighted", metavar="true/false", help="Match colors with perceptual weighting when not dithering (default false)", dest="weighted", type=parsebool, default=False)
 	
 	aname = "decode-tiles"
 	ahelp = "Decode a 4bpp tilesheet to a sheet image"
@@ -112,6 +191,8 @@ def main(args):
 	parser_enc_tiles.add_argument("path_res_tiles_out", metavar="res_tiles.bin", help="Tilesheet resource file output path")
 	parser_enc_tiles.add_argument("-c", "--compressed", metavar="true/false", help="Compress tilesheet resource on save (default true)", dest="compressed", type=parsebool, default=True)
 	parser_enc_tiles.add_argument("-i", "--indexed", metavar="true/false", help="Read an indexed-color image (default false)", dest="indexed", type=parsebool, default=False)
+	parser_enc_tiles.add_argument("-k", "--cache", metavar="cache_dir", help="Directory to cache compressed resources in (default none)", dest="cache", default=None)
+	parser_enc_tiles.add_argument("-l", "--level", metavar="level", help="Compression level 0=greedy, 1=lazy, 2=optimal (default 0)", dest="level", type=parsenum, default=0)
 	parser_enc_tiles.add_argument("-n", "--num_tiles", metavar="num", help="Specify number of tiles in sheet (default up to last non-empty tile)", dest="num_tiles", type=parsenum, default=-1)
 	
 	aname = "decode-tilemap"
@@ -140,10 +221,13 @@ def main(args):
 	afunc = cmd_derive_palette
 	parser_derive_palette = subparsers.add_parser(aname, prog=f"{progname} {aname}", help=ahelp)
 	parser_derive_palette.set_defaults(action=afunc)
-	parser_derive_palette.add_argument("path_image_in", metavar="input.png", help="Image input path")
+	parser_derive_palette.add_argument("path_image_in", metavar="input.png", help="Image input paths, one palette is derived for all of them", nargs="+")
 	parser_derive_palette.add_argument("path_res_pal_out", metavar="res_palette.bin", help="Palette resource file output path")
+	parser_derive_palette.add_argument("-i", "--iterations", metavar="iterations", help="Maximum k-means refinement passes (default 16)", dest="iterations", type=parsenum, default=16)
+	parser_derive_palette.add_argument("-m", "--method", metavar="method", help="Quantization method 0=median-cut, 1=k-means (default 1)", dest="method", type=parsenum, default=1)
 	parser_derive_palette.add_argument("-p", "--palette_size", metavar="palette_size", help="Size of palette to generate (default 256)", dest="palsize", type=parsenum, default=256)
 	parser_derive_palette.add_argument("-t", "--transparent", metavar="true/false", help="Color 0 is transparent (default false)", dest="transparent", type=parsebool, default=False)
+	parser_derive_palette.add_argument("-w", "--weighted", metavar="true/false", help="Match colors with perceptual weighting (default false)", dest="weighted", type=parsebool, default=False)
 	
 	aname = "decode-metasprite"
 	ahelp = "Decode a metasprite to a text representation"
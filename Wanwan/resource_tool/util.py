@@ -1,5 +1,7 @@
+import mmap
 import os
 import struct
+import numpy as np
 from PIL import Image
 
 def parsenum(x):
@@ -35,6 +37,39 @@ def rgb2col(c, top=255):
 	b = round(c[2] * 31 / top) & 31
 	return r<<10 | g<<5 | b
 
+def col2rgb_array(cols, top=255):
+	# Vectorised col2rgb, returns an int32 array with a trailing axis of r, g, b
+	cols = np.asarray(cols, dtype=np.int32)
+	c5 = np.stack([(cols>>10)&31, (cols>>5)&31, cols&31], axis=-1)
+	return np.rint(c5 * top / 31).astype(np.int32)
+
+def rgb2col_array(rgb, top=255):
+	# Vectorised rgb2col, takes an array with a trailing axis of r, g, b and returns a uint16 array
+	c5 = np.rint(np.asarray(rgb, dtype=np.int32) * 31 / top).astype(np.int32) & 31
+	return (c5[...,0]<<10 | c5[...,1]<<5 | c5[...,2]).astype(np.uint16)
+
+NEAREST_CHUNK_SIZE = 0x1000
+
+def nearest_color_indices(rgb, palette_rgb, weights=None):
+	# Find the nearest palette color for every pixel of an (..., 3) RGB array, by squared distance
+	# weights optionally scales the squared difference of each channel
+	# Each distinct color is searched once, expanding the distance as |c|^2 - 2c.p + |p|^2 and dropping the constant |c|^2 so the search is
+	# a matrix product, done in chunks so the distance matrix stays small. All terms are integers, so ties are exact
+	# returns a uint8 array of palette indices with the shape of the pixels, ties going to the lowest index
+	rgb = np.asarray(rgb, dtype=np.uint8)
+	palette_rgb = np.asarray(palette_rgb, dtype=np.float64).reshape(-1, 3)
+	weights = np.ones(3) if weights is None else np.asarray(weights, dtype=np.float64)
+	packed = (rgb[...,0].astype(np.uint32)<<16) | (rgb[...,1].astype(np.uint32)<<8) | rgb[...,2]
+	colors, inverse = np.unique(packed.ravel(), return_inverse=True)
+	colors_rgb = np.stack([colors>>16, (colors>>8)&255, colors&255], axis=1).astype(np.float64)
+	palette_weighted = (palette_rgb*weights).T
+	palette_norm = (palette_rgb*palette_rgb) @ weights
+	color_indices = np.empty(len(colors), dtype=np.uint8)
+	for pos in range(0, len(colors), NEAREST_CHUNK_SIZE):
+		dist = palette_norm - 2*(colors_rgb[pos:pos+NEAREST_CHUNK_SIZE] @ palette_weighted)
+		color_indices[pos:pos+NEAREST_CHUNK_SIZE] = np.argmin(dist, axis=1)
+	return color_indices[inverse].reshape(packed.shape)
+
 def rgbhex(rgb):
 	return f"#{rgb[0]&255:02X}{rgb[1]&255:02X}{rgb[2]&255:02X}"
 
@@ -105,10 +140,49 @@ def make_dirs_for_file(filepath):
 def paths_equivalent(a, b):
 	return os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
 
+def map_file(filepath):
+	# Map a file read-only and return a zero-copy memoryview of it
+	# The mapping stays valid after the file is closed, and is released with the last view of it
+	with open(filepath, "rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return memoryview(b"")
+		return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+FILL_CHUNK_SIZE = 0x10000
+
+def is_filled(data, value):
+	# Check that data contains only the given byte value, comparing a chunk at a time
+	chunk = bytes([value])*FILL_CHUNK_SIZE
+	for pos in range(0, len(data), FILL_CHUNK_SIZE):
+		part = data[pos:pos+FILL_CHUNK_SIZE]
+		if part != chunk[:len(part)]:
+			return False
+	return True
+
+def strip_fill(data, value):
+	# Returns the length of data once any trailing run of the given byte value is removed
+	# Chunks are checked from the end, so only the chunk where the run starts is copied
+	chunk = bytes([value])*FILL_CHUNK_SIZE
+	end = len(data)
+	while end > 0:
+		start = max(0, end-FILL_CHUNK_SIZE)
+		part = data[start:end]
+		if part != chunk[:len(part)]:
+			return start+len(bytes(part).rstrip(chunk[:1]))
+		end = start
+	return 0
+
+def write_fill(f, value, count):
+	# Write count copies of the given byte value at the current position
+	chunk = bytes([value])*min(count, FILL_CHUNK_SIZE)
+	while count > 0:
+		f.write(chunk[:count])
+		count -= len(chunk)
+
 def load_image_as_grayscale(img, max_colors=256):
 	max_colors = min(max(2, max_colors), 256)
 	img = Image.alpha_composite(Image.new("RGBA", img.size, (0,0,0,0)), img.convert("RGBA")).convert("L")
-	img.putdata([round(x*(max_colors-1)/255) for x in list(img.getdata())])
+	img = img.point([round(x*(max_colors-1)/255) for x in range(256)])
 	return img
 
 def load_image_as_indexed(img, max_colors=256):
@@ -133,20 +207,20 @@ def load_image_as_indexed(img, max_colors=256):
 					transp_list[i] = True
 					transp = True
 	#print("Detected transparency: " + ("YES" if transp else "NO"))
+	data_image = np.asarray(img)
 	if transp:
-		data_image = list(img.getdata())
 		print("Mapping all transparency to color 0")
-		pixel_value_map = list(range(256))
+		pixel_value_map = np.zeros(256, dtype=np.uint8)
 		next_opaque = 1
 		for i in range(256):
-			if transp_list[i]:
-				pixel_value_map[i] = 0
-			else:
+			if not transp_list[i]:
 				pixel_value_map[i] = next_opaque
 				next_opaque += 1
-		data_image = list(map(lambda x: pixel_value_map[x], data_image))
-		img.putdata(data_image)
-	max_used_color = max(list(img.getdata()))
+		data_image = pixel_value_map[data_image]
+		img_palette = img.getpalette()
+		img = Image.frombytes("P", img.size, data_image.tobytes())
+		img.putpalette(img_palette)
+	max_used_color = int(data_image.max(initial=0))
 	if max_used_color >= max_colors:
 		print(f"Used palette exceeds maximum of {max_colors} colors")
 		return None